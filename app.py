@@ -1,64 +1,85 @@
 """This is the main file for the chatbot application."""
+import asyncio
+import base64
+import binascii
+import contextlib
 import datetime
+import glob
 import logging
 import os
+import tempfile
+import time
 import json
 import uuid
-from google.cloud import firestore as google_firestore
-from fastapi import FastAPI, HTTPException, Depends, status, BackgroundTasks
+from fastapi import APIRouter, FastAPI, HTTPException, Depends, status, BackgroundTasks, Request, Response, Header, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 from jose import jwt
 from pydantic import BaseModel, ValidationError
 from typing import Optional
-import requests
-from langchain_openai import ChatOpenAI
+import httpx
 import dotenv
-from langchain.prompts import (
+from langchain_core.prompts import (
     ChatPromptTemplate,
     MessagesPlaceholder,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
 )
-from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferMemory
-from langchain_anthropic import ChatAnthropic
-from langchain_mistralai import ChatMistralAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.chat_models import ChatPerplexity
-from langchain_together import ChatTogether
-from langchain_core.output_parsers import StrOutputParser
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-from google.cloud.firestore_v1.base_query import FieldFilter
 import uvicorn
-import razorpay
-from razorpay.resources.subscription import Subscription
-from razorpay.resources.customer import Customer
-from razorpay.resources.order import Order
-from razorpay.resources.payment import Payment
-import tiktoken
-from anthropic import Anthropic
-from vertexai.preview import tokenization
 import hmac
 import hashlib
+from client_pool import ChatClientPool
+import token_counter
+from repository import DocumentExists, InMemoryRepository, TimedRepository, Write
+from write_behind import WriteBehindQueue
+from quota import QuotaManager
+from cache import TTLCache, VerifiedTokenCache
+from conversation_store import ConversationStore
+from context_window import ContextBuilder, SUMMARY_MODEL as DEFAULT_SUMMARY_MODEL
+from response_cache import ResponseCache
+from title_generator import TitleGenerator, TITLE_MODEL as DEFAULT_TITLE_MODEL
+import sse
+from cancellation import DisconnectMonitor
+from scheduler import Scheduler, QueueTimeout, PAID, FREE
+from hedging import hedged_stream, HedgeResult
+from circuit_breaker import CircuitBreakers
+from background_calls import BackgroundCaller
+import metrics
+from profiling import RequestTimings, SamplingProfiler
 
 
 
 dotenv.load_dotenv()
 
-app = FastAPI()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """
+    Create the clients, start the write-behind queue, load the tokenizers of the enabled models once
+    and start the token counting workers. On shutdown drain the queue and close the connections and workers.
+    """
+    init_clients()
+    write_behind_queue.start()
+    models = [(model_name, config['company']) for model_name, config in model_company_mapping.items()]
+    await asyncio.to_thread(token_counter.warm_up, models)
+    token_counter.start_process_pool(models)
+    metrics_task = asyncio.create_task(write_metrics_periodically()) if METRICS_DIR else None
+    yield
+    if metrics_task is not None:
+        metrics_task.cancel()
+        # the last values of a recycled worker keep counting on /metrics
+        metrics.REGISTRY.write_snapshot(METRICS_DIR)
+    await write_behind_queue.stop()
+    await chat_client_pool.aclose()
+    await google_http_client.aclose()
+    token_counter.shutdown_process_pool()
+
+
+# Endpoints are declared on a router and mounted by create_app(), once per worker process
+router = APIRouter()
 
 # Set up logging with the configured log level from environment variables or default to ERROR.
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "ERROR"))
@@ -77,25 +98,43 @@ def get_environment_variable(key):
 RAZORPAY_KEY_ID = get_environment_variable("RAZOR_PAY_KEY_ID")
 RAZORPAY_KEY_SECRET = get_environment_variable("RAZOR_PAY_KEY_SECRET")
 ENABLE_PAYMENT = get_environment_variable("ENABLE_PAYMENT") == "True"
+ENABLE_RESPONSE_CACHE = get_environment_variable("ENABLE_RESPONSE_CACHE") == "True"
+# Tokens streamed within SSE_COALESCE_MS of each other are sent as one frame of at most SSE_COALESCE_CHARS characters,
+# SSE_COALESCE_MS=0 sends every token in a frame of its own
+SSE_COALESCE_MS = float(get_environment_variable("SSE_COALESCE_MS") or 15)
+SSE_COALESCE_CHARS = int(get_environment_variable("SSE_COALESCE_CHARS") or 512)
+# With ENABLE_HEDGING=True a model's hedge_model is raced when no token arrived within HEDGE_TTFT_SECONDS
+ENABLE_HEDGING = get_environment_variable("ENABLE_HEDGING") == "True"
+HEDGE_TTFT_SECONDS = float(get_environment_variable("HEDGE_TTFT_SECONDS") or 4)
+
+# Clients that open connections or load provider SDKs are created by init_clients() when the application starts
+repository = None
+write_behind_queue = None
+quota = None
+conversation_store = None
+client = None
+google_http_client = None
+chat_client_pool = None
+context_builder = None
+title_generator = None
 
-# Initialize a Firestore client with a specific service account key file
-if get_environment_variable("ENVIRONMENT") == "dev":
-    cred = credentials.Certificate("serviceAccount.json")
-    firebase_admin.initialize_app(cred)
-else:
-    firebase_admin.initialize_app()
+# This will just define that the Authorization header is required
+auth_scheme = HTTPBearer()
 
-db = firestore.client()
+# Verified Google userinfo responses keyed by a hash of the access token
+google_token_cache = TTLCache(max_size=10000, ttl=300)
 
-client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
-# Create an instance of the Subscription class
-subscription = Subscription(client)
-customer = Customer(client)
+# Users already known to exist in the users collection
+known_users_cache = TTLCache(max_size=100000, ttl=24 * 60 * 60)
 
-# This will just define that the Authorization header is required
-auth_scheme = HTTPBearer()
+# Cursor at the end of each page-number page of /v1/chat_history, so sequential pages skip the offset scan
+chat_history_page_cursors = TTLCache(max_size=10000, ttl=600)
 
-anthropic = Anthropic()
+# Users who have purchased generations, their calls are scheduled first
+paid_users_cache = TTLCache(100000, 600)
+
+# Decoded JWT claims keyed by a digest of the token, so repeat requests skip signature verification
+jwt_claims_cache = VerifiedTokenCache(max_size=10000, ttl=300)
 
 class ChatHistory(BaseModel):
     """Chat history model for the request and response."""
@@ -108,7 +147,8 @@ class ChatRequest(BaseModel):
     """Chat request model for the chat endpoint."""
 
     user_input: str
-    chat_history: list[ChatHistory]
+    # None means the server rebuilds the history of chat_id from its own store
+    chat_history: Optional[list[ChatHistory]] = None
     chat_model: str = "gpt-3.5-turbo"
     temperature: float = 0.8
     chat_id: Optional[str] = None
@@ -151,252 +191,437 @@ class PaymentRequest(BaseModel):
 
 model_company_mapping = {
     "gpt-3.5-turbo": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": False,
         "company": "OpenAI",
         "input_token_cost_per_million": 0.5,
-        "output_token_cost_per_million": 1.5
+        "output_token_cost_per_million": 1.5,
+        "context_window": 16385,
+        "hedge_model": "gpt-4o-mini"
     },
     "gpt-4-turbo-preview": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": True,
         "company": "OpenAI",
         "input_token_cost_per_million": 10.0,
-        "output_token_cost_per_million": 30.0
+        "output_token_cost_per_million": 30.0,
+        "context_window": 128000,
+        "max_concurrency": 20,
+        "tokens_per_minute": 300000
     },
     "gpt-4o-mini": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": False,
         "company": "OpenAI",
         "input_token_cost_per_million": 0.15,
-        "output_token_cost_per_million": 0.6
+        "output_token_cost_per_million": 0.6,
+        "context_window": 128000,
+        "hedge_model": "claude-3-haiku-20240307"
     },
     "gpt-4o": {
-        "model": ChatOpenAI,
+        "model": "langchain_openai:ChatOpenAI",
         "premium": True,
         "company": "OpenAI",
         "input_token_cost_per_million": 5.0,
-        "output_token_cost_per_million": 15.0
+        "output_token_cost_per_million": 15.0,
+        "context_window": 128000,
+        "hedge_model": "claude-3-5-sonnet-20240620"
     },
     "claude-3-opus-20240229": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": True,
         "company": "Anthropic",
         "input_token_cost_per_million": 15.0,
-        "output_token_cost_per_million": 75.0
+        "output_token_cost_per_million": 75.0,
+        "context_window": 200000,
+        "max_concurrency": 20,
+        "tokens_per_minute": 200000
     },
     "claude-3-sonnet-20240229": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": True,
         "company": "Anthropic",
         "input_token_cost_per_million": 3.0,
-        "output_token_cost_per_million": 15.0
+        "output_token_cost_per_million": 15.0,
+        "context_window": 200000
     },
     "claude-3-haiku-20240307": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": False,
         "company": "Anthropic",
         "input_token_cost_per_million": 0.25,
-        "output_token_cost_per_million": 1.25
+        "output_token_cost_per_million": 1.25,
+        "context_window": 200000,
+        "hedge_model": "gpt-4o-mini"
     },
     "claude-3-5-sonnet-20240620": {
-        "model": ChatAnthropic,
+        "model": "langchain_anthropic:ChatAnthropic",
         "premium": True,
         "company": "Anthropic",
         "input_token_cost_per_million": 3.0,
-        "output_token_cost_per_million": 15.0
+        "output_token_cost_per_million": 15.0,
+        "context_window": 200000,
+        "hedge_model": "gpt-4o"
     },
     "mistral-tiny-2312": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": False,
         "company": "Mistral",
         "input_token_cost_per_million": 0.25,
-        "output_token_cost_per_million": 0.25
+        "output_token_cost_per_million": 0.25,
+        "context_window": 32000
     },
     "mistral-small-2312": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": False,
         "company": "Mistral",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.7
+        "output_token_cost_per_million": 0.7,
+        "context_window": 32000
     },
     "mistral-small-2402": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": False,
         "company": "Mistral",
         "input_token_cost_per_million": 1.0,
-        "output_token_cost_per_million": 3.0
+        "output_token_cost_per_million": 3.0,
+        "context_window": 32000
     },
     "mistral-medium-2312": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": True,
         "company": "Mistral",
         "input_token_cost_per_million": 2.7,
-        "output_token_cost_per_million": 8.1
+        "output_token_cost_per_million": 8.1,
+        "context_window": 32000
     },
     "mistral-large-2402": {
-        "model": ChatMistralAI,
+        "model": "langchain_mistralai:ChatMistralAI",
         "premium": True,
         "company": "Mistral",
         "input_token_cost_per_million": 4.0,
-        "output_token_cost_per_million": 12.0
+        "output_token_cost_per_million": 12.0,
+        "context_window": 32000
     },
     "gemini-1.0-pro": {
-        "model": ChatGoogleGenerativeAI,
+        "model": "langchain_google_genai:ChatGoogleGenerativeAI",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.5,
-        "output_token_cost_per_million": 1.5
+        "output_token_cost_per_million": 1.5,
+        "context_window": 30720
     },
     "gemini-1.5-flash-latest": {
-        "model": ChatGoogleGenerativeAI,
+        "model": "langchain_google_genai:ChatGoogleGenerativeAI",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.35,
-        "output_token_cost_per_million": 1.05
+        "output_token_cost_per_million": 1.05,
+        "context_window": 1048576,
+        "hedge_model": "gpt-4o-mini"
     },
     "gemini-1.5-pro-latest": {
-        "model": ChatGoogleGenerativeAI,
+        "model": "langchain_google_genai:ChatGoogleGenerativeAI",
         "premium": True,
         "company": "Google",
         "input_token_cost_per_million": 3.5,
-        "output_token_cost_per_million": 10.5
+        "output_token_cost_per_million": 10.5,
+        "context_window": 2097152
     },
     "llama-3-sonar-small-32k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": False,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 28000
     },
     "llama-3-sonar-small-32k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 32768
     },
     "llama-3-sonar-large-32k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": False,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 28000
     },
     "llama-3-sonar-large-32k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 32768
     },
     "llama-3.1-sonar-small-128k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 127072
     },
     "llama-3.1-sonar-small-128k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 131072,
+        "hedge_model": "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo"
     },
     "llama-3.1-sonar-large-128k-online": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 127072
     },
     "llama-3.1-sonar-large-128k-chat": {
-        "model": ChatPerplexity,
+        "model": "langchain_community.chat_models:ChatPerplexity",
         "premium": True,
         "company": "Perplexity",
         "input_token_cost_per_million": 1,
-        "output_token_cost_per_million": 1
+        "output_token_cost_per_million": 1,
+        "context_window": 131072,
+        "hedge_model": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo"
     },
     "codellama/CodeLlama-34b-Instruct-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Meta",
         "input_token_cost_per_million": 0.78,
-        "output_token_cost_per_million": 0.78
+        "output_token_cost_per_million": 0.78,
+        "context_window": 16384
     },
     "codellama/CodeLlama-70b-Instruct-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.9,
-        "output_token_cost_per_million": 0.9
+        "output_token_cost_per_million": 0.9,
+        "context_window": 4096
     },
     "meta-llama/Llama-2-13b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Meta",
         "input_token_cost_per_million": 0.22,
-        "output_token_cost_per_million": 0.22
+        "output_token_cost_per_million": 0.22,
+        "context_window": 4096
     },
     "meta-llama/Llama-2-70b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.9,
-        "output_token_cost_per_million": 0.9
+        "output_token_cost_per_million": 0.9,
+        "context_window": 4096
     },
     "meta-llama/Llama-3-8b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Meta",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 8192
     },
     "meta-llama/Llama-3-70b-chat-hf": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.9,
-        "output_token_cost_per_million": 0.9
+        "output_token_cost_per_million": 0.9,
+        "context_window": 8192
     },
     "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.8
+        "output_token_cost_per_million": 0.8,
+        "context_window": 131072,
+        "hedge_model": "llama-3.1-sonar-small-128k-chat"
     },
     "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.8
+        "output_token_cost_per_million": 0.8,
+        "context_window": 131072,
+        "hedge_model": "llama-3.1-sonar-large-128k-chat"
     },
     "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": True,
         "company": "Meta",
         "input_token_cost_per_million": 0.7,
-        "output_token_cost_per_million": 0.8
+        "output_token_cost_per_million": 0.8,
+        "context_window": 130815
     },
     "google/gemma-2b-it": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.1,
-        "output_token_cost_per_million": 0.1
+        "output_token_cost_per_million": 0.1,
+        "context_window": 8192
     },
     "google/gemma-7b-it": {
-        "model": ChatTogether,
+        "model": "langchain_together:ChatTogether",
         "premium": False,
         "company": "Google",
         "input_token_cost_per_million": 0.2,
-        "output_token_cost_per_million": 0.2
+        "output_token_cost_per_million": 0.2,
+        "context_window": 8192
+    }
+}
+
+# The API serving each model class, circuit breakers and rate limits are per serving API, e.g. Gemma is served by Together, not Google
+SERVING_PROVIDERS = {
+    "langchain_openai:ChatOpenAI": "OpenAI",
+    "langchain_anthropic:ChatAnthropic": "Anthropic",
+    "langchain_mistralai:ChatMistralAI": "Mistral",
+    "langchain_google_genai:ChatGoogleGenerativeAI": "Google",
+    "langchain_community.chat_models:ChatPerplexity": "Perplexity",
+    "langchain_together:ChatTogether": "Together",
+}
+for config in model_company_mapping.values():
+    config.setdefault("provider", SERVING_PROVIDERS[config["model"]])
+
+# ENABLED_PROVIDERS=OpenAI,Anthropic serves only the models of those serving providers, so the other SDKs are never imported
+ENABLED_PROVIDERS = get_environment_variable("ENABLED_PROVIDERS")
+if ENABLED_PROVIDERS:
+    enabled_providers = {provider.strip() for provider in ENABLED_PROVIDERS.split(",") if provider.strip()}
+    unknown_providers = enabled_providers - set(SERVING_PROVIDERS.values())
+    if unknown_providers:
+        raise ValueError(f"Unknown ENABLED_PROVIDERS {', '.join(sorted(unknown_providers))}, the providers are {', '.join(SERVING_PROVIDERS.values())}")
+    model_company_mapping = {
+        model_name: config for model_name, config in model_company_mapping.items()
+        if config["provider"] in enabled_providers
     }
+    for config in model_company_mapping.values():
+        if config.get("hedge_model") not in model_company_mapping:
+            config.pop("hedge_model", None)
+
+
+def background_model(key, default):
+    """
+    Return the model set in the environment variable key for background calls, or default.
+    A default of a disabled provider falls back to the cheapest enabled non-premium model.
+    """
+    model_name = get_environment_variable(key)
+    if model_name:
+        if model_name not in model_company_mapping:
+            raise ValueError(f"{key}={model_name} is not a model of the enabled providers")
+        return model_name
+    if default in model_company_mapping:
+        return default
+    candidates = [name for name, config in model_company_mapping.items() if not config["premium"]] or list(model_company_mapping)
+    if not candidates:
+        raise ValueError(f"{key} has no model to use, ENABLED_PROVIDERS enables none")
+    return min(candidates, key=lambda name: model_company_mapping[name]["input_token_cost_per_million"] + model_company_mapping[name]["output_token_cost_per_million"])
+
+
+# Models titling chats and summarizing old turns, checked at startup so a disabled one does not fail in the background
+TITLE_MODEL = background_model("TITLE_MODEL", DEFAULT_TITLE_MODEL)
+SUMMARY_MODEL = background_model("SUMMARY_MODEL", DEFAULT_SUMMARY_MODEL)
+
+# Concurrency and tokens-per-minute budgets per serving provider, kept under the account rate limits.
+# Every model served by Together, Llama and Gemma alike, shares the Together account limits
+provider_limits = {
+    "OpenAI": {"concurrency": 200, "tokens_per_minute": 2000000},
+    "Anthropic": {"concurrency": 100, "tokens_per_minute": 400000},
+    "Mistral": {"concurrency": 50, "tokens_per_minute": 500000},
+    "Google": {"concurrency": 100, "tokens_per_minute": 1000000},
+    "Perplexity": {"concurrency": 50, "tokens_per_minute": None},
+    "Together": {"concurrency": 100, "tokens_per_minute": None},
 }
 
+# Worker processes serving the app, see serve(). Every worker schedules on its own, so each gets an equal share of the budgets
+WEB_CONCURRENCY = int(get_environment_variable("WEB_CONCURRENCY") or 1)
+
+
+def worker_share(limits):
+    """Divide the concurrency and tokens-per-minute budgets of limits between the worker processes."""
+    return {key: None if value is None else max(value // WEB_CONCURRENCY, 1) for key, value in limits.items()}
+
+
+# Calls wait for their provider and model budgets, paid users first and round robin across users
+scheduler = Scheduler({company: worker_share(limits) for company, limits in provider_limits.items()}, {
+    model_name: worker_share({"concurrency": config.get("max_concurrency"), "tokens_per_minute": config.get("tokens_per_minute")})
+    for model_name, config in model_company_mapping.items()
+    if "max_concurrency" in config or "tokens_per_minute" in config
+})
+
+# Providers failing or slow on real traffic are failed fast until a probe call succeeds again
+circuit_breakers = CircuitBreakers()
+
+# Output tokens assumed for a call until its actual usage is known
+ESTIMATED_OUTPUT_TOKENS = 500
+
+# Answers to temperature 0 prompts, replayed without calling the provider when ENABLE_RESPONSE_CACHE=True
+response_cache = ResponseCache()
+
+# Streams whose client went away are cancelled upstream instead of generating to the end
+disconnect_monitor = DisconnectMonitor()
+
+# PROFILE_SAMPLE_PERCENT of the chat requests, and those sending PROFILE_ADMIN_TOKEN in X-Profile, are profiled
+profiler = SamplingProfiler(
+    sample_percent=float(get_environment_variable("PROFILE_SAMPLE_PERCENT") or 0),
+    admin_token=get_environment_variable("PROFILE_ADMIN_TOKEN"),
+)
+
+# Served on /metrics, observed once per stream rather than per token
+time_to_first_token_seconds = metrics.Histogram("chat_time_to_first_token_seconds", "Time from the provider call to its first token.", ("model", "company"))
+tokens_per_second = metrics.Histogram("chat_tokens_per_second", "Output tokens per second after the first token.", ("model", "company"), buckets=(1, 5, 10, 20, 35, 50, 75, 100, 150, 200, 300, 500))
+stream_duration_seconds = metrics.Histogram("chat_stream_duration_seconds", "Time from the start of a stream to its last token.", ("model", "company"))
+calculate_cost_seconds = metrics.Histogram("chat_calculate_cost_seconds", "Duration of calculate_cost.", buckets=(0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001))
+firestore_operation_seconds = metrics.Histogram("firestore_operation_seconds", "Latency of the data-access calls per collection.", ("collection", "operation"))
+chat_requests = metrics.Counter("chat_requests", "Chat turns by outcome: completed, disconnected, cached or failed.", ("model", "company", "outcome"))
+chat_input_tokens = metrics.Counter("chat_input_tokens", "Prompt tokens sent to the provider.", ("model", "company"))
+chat_output_tokens = metrics.Counter("chat_output_tokens", "Output tokens received from the provider.", ("model", "company"))
+chat_cost_dollars = metrics.Counter("chat_cost_dollars", "Cost of the provider calls in dollars.", ("model", "company"))
+request_phase_seconds = metrics.Histogram("chat_request_phase_seconds", "Duration of each phase of a chat request.", ("phase",))
+background_requests = metrics.Counter("background_requests", "Title and summary calls by outcome: completed or failed.", ("model", "company", "purpose", "outcome"))
+background_tokens = metrics.Counter("background_tokens", "Tokens of the title and summary calls.", ("model", "company", "purpose", "direction"))
+background_cost_dollars = metrics.Counter("background_cost_dollars", "Cost of the title and summary calls in dollars.", ("model", "company", "purpose"))
+
+
+def init_metric_labels():
+    """Create the series of every model up front, so they are exported as 0 before the first chat."""
+    for model_name, config in model_company_mapping.items():
+        for outcome in ("completed", "disconnected", "cached", "failed"):
+            chat_requests.labels(model_name, config["company"], outcome)
+        for counter in (chat_input_tokens, chat_output_tokens, chat_cost_dollars):
+            counter.labels(model_name, config["company"])
+
+
+init_metric_labels()
+
+# Directory the worker processes write their metrics to, so /metrics of any worker sums all of them, see serve()
+METRICS_DIR = get_environment_variable("METRICS_DIR")
+METRICS_WRITE_SECONDS = 5
+
+
+async def write_metrics_periodically():
+    """Write the metrics of this worker to METRICS_DIR every METRICS_WRITE_SECONDS."""
+    while True:
+        await asyncio.sleep(METRICS_WRITE_SECONDS)
+        try:
+            await asyncio.to_thread(metrics.REGISTRY.write_snapshot, METRICS_DIR)
+        except OSError as e:
+            logging.error(f'Error writing the metrics to {METRICS_DIR}: {e}')
+
 
 # Get the secret key from the environment variable
 SECRET_KEY = get_environment_variable("SECRET_KEY")
@@ -409,132 +634,112 @@ if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
     raise ValueError("GOOGLE_CLIENT_ID or GOOGLE_CLIENT_SECRET environment variable is not set")    
 
 
-async def add_user_to_db(user_ref, user_data):
+async def add_user_to_db(google_user_id, user_data):
     """
     Background task to add or update the user in the database.
     """
-    user = user_ref.get()
-    if user.exists:
+    if known_users_cache.peek(google_user_id):
         return
-    else:
-        # add created_at to the user_data
-        user_data['created_at'] = google_firestore.SERVER_TIMESTAMP
-        user_ref.set(user_data)
+    user = await repository.get_user(google_user_id)
+    if not user:
+        await repository.create_user(google_user_id, user_data)
+    known_users_cache.set(google_user_id, True)
 
 
-def add_message_to_db(request, google_user_id, user_message, ai_message, stats):
+async def resolve_chat_id(request, google_user_id):
     """
-    Background task to add the chat message to the database.
+    Return the (chat_id, is_new_chat, turn_count) the message will be saved under, so the chat_id is known before streaming.
+    turn_count is the number of turns the database has of an existing chat, None for chats saved before turns were counted.
     """
-    chat_id = None
-
-    # Check if chat_id key exists in the request
-    if not hasattr(request, 'chat_id'):
-        logging.error('Request object does not have a chat_id attribute')
-        return None
+    if request.chat_id:
+        # A chat created by a turn that is still in the write-behind queue is not in the database yet
+        chat_data = write_behind_queue.pending('chats', request.chat_id) or await repository.get_chat(request.chat_id)
+        if chat_data:
+            # Check if the google_user_id matches the google_user_id in the chat
+            if chat_data['google_user_id'] != google_user_id:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="Forbidden",
+                )
+            return request.chat_id, False, chat_data.get('turn_count')
 
-    chat_id = request.chat_id
+    # Create a new chat id for the chat
+    return str(uuid.uuid4()), True, 0
 
-    # Check if the chat_id exists in the database in the chat_id column
-    chat_ref = db.collection('chats').where(filter=FieldFilter('chat_id', '==', chat_id)).limit(1).stream()
-    chat_data = next(chat_ref, None)
 
-    if chat_data:
-        # Check if the google_user_id matches the google_user_id in the chat
-        chat_data = chat_data.to_dict()
-        if chat_data['google_user_id'] == google_user_id:
-            try:
-                # Update the chat with the new message
-                chat_doc_ref = db.collection('chats').document(chat_id)
-                chat_doc_ref.update({
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                    'model' : request.chat_model
-                })
-                db.collection('chat_history').add({
-                    'ai_message': ai_message,
-                    'user_message': user_message,
-                    'chat_id': chat_id,
-                    'created_at': google_firestore.SERVER_TIMESTAMP,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                    'regenerate_message' : request.regenerate_message,
-                    'model' : request.chat_model,
-                    'stats' : stats
-                })
-            except Exception as e:
-                logging.error(f'Error updating chat: {e}')
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Forbidden",
-            )
+def add_message_to_db(request, chat_id, is_new_chat, google_user_id, user_message, ai_message, stats):
+    """
+    Queue the chat message writes, they are committed to the database in a batch by the write-behind queue.
+    """
+    writes = []
+    if is_new_chat:
+        writes.append(Write('set', 'chats', chat_id, {
+            'chat_id': chat_id,
+            'google_user_id': google_user_id,
+            'model' : request.chat_model,
+            'turn_count': 1,
+        }))
     else:
-        try:
-            # Create a new chat id and add the chat to the database
-            chat_id = str(uuid.uuid4())
-            new_chat_ref = db.collection('chats').document(chat_id)
-            new_chat_ref.set({
-                'chat_id': chat_id,
-                'google_user_id': google_user_id,
-                'created_at': google_firestore.SERVER_TIMESTAMP,
-                'updated_at': google_firestore.SERVER_TIMESTAMP,
-                'model' : request.chat_model,
-            })
-            db.collection('chat_history').add({
-                'ai_message': ai_message,
-                'user_message': user_message,
-                'chat_id': chat_id,
-                'created_at': google_firestore.SERVER_TIMESTAMP,
-                'updated_at': google_firestore.SERVER_TIMESTAMP,
-                'regenerate_message' : request.regenerate_message,
-                'model' : request.chat_model,
-                'stats' : stats
-            })
-        except Exception as e:
-            logging.error(f'Error creating new chat: {e}')
-            return None
-
-    return chat_id
-
-
-def calculate_cost(input_string, output_string, model_name):
+        writes.append(Write('update', 'chats', chat_id, {
+            'model' : request.chat_model
+        }))
+        # Workers compare it with their cached conversation, see ConversationStore
+        writes.append(Write('increment', 'chats', chat_id, {'turn_count': 1}))
+    writes.append(Write('set', 'chat_history', str(uuid.uuid4()), {
+        'ai_message': ai_message,
+        'user_message': user_message,
+        'chat_id': chat_id,
+        'regenerate_message' : request.regenerate_message,
+        'model' : request.chat_model,
+        'stats' : stats
+    }))
+    write_behind_queue.enqueue(writes)
+    conversation_store.add_turn(chat_id, user_message, ai_message, request.regenerate_message, is_new_chat)
+
+
+async def get_request_turns(request, chat_id, is_new_chat, turn_count=None):
+    """
+    Return the (user_message, ai_message) turns preceding the request, from the request itself
+    or, when the client only sent chat_id, from the server-side conversation store.
+    """
+    if request.chat_history is not None:
+        return [(chat_history.user_message, chat_history.ai_message) for chat_history in request.chat_history]
+    if is_new_chat:
+        return []
+    turns = await conversation_store.get_turns(chat_id, turn_count)
+    if request.regenerate_message and turns:
+        # The regenerated turn replaces the last one, so it is not part of its own context
+        turns = turns[:-1]
+    return turns
+
+
+def calculate_cost(input_token_length, output_token_length, model_name):
     """
     Calculate the cost of the chat based on the input and output token lengths.
     """
+    started = time.perf_counter()
     chat_config = model_company_mapping.get(model_name)
-    input_token_length = 0
-    output_token_length = 0
-
-    if chat_config['company'] == 'OpenAI':
-        encoding = tiktoken.encoding_for_model(model_name)
-        input_token_length = len(encoding.encode(input_string))
-        output_token_length = len(encoding.encode(output_string))
-    
-    if chat_config['company'] == 'Anthropic':
-        input_token_length = anthropic.count_tokens(input_string)
-        output_token_length = anthropic.count_tokens(output_string)
-    
-    if chat_config['company'] == 'Mistral' or chat_config['company'] == 'Perplexity' or chat_config['company'] == 'Meta':
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        input_token_length = len(encoding.encode(input_string))
-        output_token_length = len(encoding.encode(output_string))
-    
-    if chat_config['company'] == 'Google':
-        tokenizer = tokenization.get_tokenizer_for_model("gemini-1.5-flash-001")
-        input_token_length = tokenizer.count_tokens(input_string).total_tokens
-        output_token_length = tokenizer.count_tokens(output_string).total_tokens
-    
     input_cost = input_token_length * chat_config['input_token_cost_per_million'] / 1000000
     output_cost = output_token_length * chat_config['output_token_cost_per_million'] / 1000000
-    return input_token_length, output_token_length, input_cost + output_cost
+    calculate_cost_seconds.labels().observe(time.perf_counter() - started)
+    return input_cost + output_cost
+
+
+def record_background_call(model_name, purpose, outcome, input_token_length, output_token_length):
+    """Count a title or summary call and its cost, passed to the BackgroundCaller."""
+    company = model_company_mapping[model_name]['company']
+    background_requests.labels(model_name, company, purpose, outcome).inc()
+    if input_token_length or output_token_length:
+        background_tokens.labels(model_name, company, purpose, "input").inc(input_token_length)
+        background_tokens.labels(model_name, company, purpose, "output").inc(output_token_length)
+        background_cost_dollars.labels(model_name, company, purpose).inc(calculate_cost(input_token_length, output_token_length, model_name))
 
 
-@app.exception_handler(Exception)
 async def generic_exception_handler(request, exc):
     """Generic exception handler to catch unexpected errors."""
     logging.error("Unexpected error occurred: %s", exc)
     return {"message": "Internal server error", "detail": str(exc)}, 500
 
-@app.exception_handler(HTTPException)
 async def custom_http_exception_handler(request, exc: HTTPException):
     """Custom HTTP exception handler to catch HTTP exceptions."""
     return JSONResponse(
@@ -546,16 +751,23 @@ async def verify_google_token(background_tasks: BackgroundTasks, credentials: HT
     """Verify the Google ID token and return the user info."""
     if credentials:
         token = credentials.credentials
+        token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
         try:
-            request = requests.get("https://www.googleapis.com/oauth2/v3/userinfo", headers={"Authorization": f"Bearer {token}"}, timeout=10)
+            credentials = google_token_cache.get(token_hash)
+            if credentials is None:
+                response = await google_http_client.get("https://www.googleapis.com/oauth2/v3/userinfo", headers={"Authorization": f"Bearer {token}"})
 
-            # Check if the request was successful
-            request.raise_for_status()
+                # Check if the request was successful
+                response.raise_for_status()
 
-            credentials = request.json()
+                credentials = response.json()
+                google_token_cache.set(token_hash, credentials)
+            credentials = dict(credentials)
+
+            if known_users_cache.get(credentials['sub']):
+                return credentials
             
             # Check if the user is in the database using the sub field, in the collection users the sub is set to google_user_id field
-            user_ref = db.collection('users').document(credentials['sub'])
             user_data = {
                 'email': credentials['email'],
                 'username': credentials['name'],
@@ -564,10 +776,10 @@ async def verify_google_token(background_tasks: BackgroundTasks, credentials: HT
             }
 
             # Add or update the user in the database as a background task
-            background_tasks.add_task(add_user_to_db, user_ref, user_data)
+            background_tasks.add_task(add_user_to_db, credentials['sub'], user_data)
 
             return credentials
-        except ValueError as exc:
+        except (ValueError, httpx.HTTPStatusError) as exc:
             # Invalid token
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -583,47 +795,42 @@ async def verify_google_token(background_tasks: BackgroundTasks, credentials: HT
 
 
 
-def get_generations(token_info: dict = Depends(verify_google_token)):
+async def get_generations(token_info: dict = Depends(verify_google_token)):
     """Verify the number of generations left for the user."""
-    # check in user_generations collection for the user
-    user_generations_ref = db.collection('user_generations').document(token_info['sub'])
-    user_generations_data = user_generations_ref.get()
-    if user_generations_data.exists:
-        user_generations_data = user_generations_data.to_dict()
-        return user_generations_data['remaining_generations']
-    else:
-        # create a new document for the user with the remaining generations
-        user_generations_ref.set({
-            'google_user_id': token_info['sub'],
-            'remaining_generations': 20,
-            'created_at': google_firestore.SERVER_TIMESTAMP,
-            'updated_at': google_firestore.SERVER_TIMESTAMP,
-        })
-        return 20
+    return await quota.remaining(token_info['sub'])
+
 
-def update_generations_left(token_info: dict = Depends(verify_google_token), generations_left: int = 30):
-    """Update the number of generations left for the user."""
-    user_generations_ref = db.collection('user_generations').document(token_info['sub'])
-    user_generations_ref.update({
-        'remaining_generations': generations_left - 1,
-        'updated_at': google_firestore.SERVER_TIMESTAMP,
-    })
+async def is_paid_user(google_user_id):
+    """Return whether the user has purchased generations."""
+    paid = paid_users_cache.get(google_user_id)
+    if paid is None:
+        paid = await repository.has_payment(google_user_id)
+        paid_users_cache.set(google_user_id, paid)
+    return paid
 
 
-@app.get("/auth/google", response_model=dict, tags=["Authentication Endpoints"])
+@router.get("/auth/google", response_model=dict, tags=["Authentication Endpoints"])
 async def google_auth(idinfo: dict = Depends(verify_google_token)):
     """Google authentication endpoint to verify the Google ID token."""
     # create a new JWT token using sub and the secret key with expiry time of 30 days
     token = jwt.encode({"sub": idinfo["sub"], "exp": datetime.datetime.utcnow() + datetime.timedelta(days=30)}, SECRET_KEY, algorithm="HS256")
     return {"accessToken": token, "user": idinfo, "token_type": "Bearer"}
 
+def request_timings(request):
+    """Return the timing breakdown of a request, started by the first phase recorded."""
+    timings = getattr(request.state, "timings", None)
+    if timings is None:
+        timings = request.state.timings = RequestTimings()
+    return timings
+
 # Example usage within your verify_token dependency
-async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+async def verify_token(request: Request, credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
     """Verify the JWT token and return the user info."""
     if credentials:
         token = credentials.credentials
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+            with request_timings(request).measure("auth"):
+                payload = jwt_claims_cache.get_claims(token, lambda token: jwt.decode(token, SECRET_KEY, algorithms=["HS256"]))
             return payload
         except jwt.JWTError as exc:
             raise HTTPException(
@@ -636,15 +843,103 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(HTTPB
             detail="Authorization header missing",
         )
     
-@app.get("/verify", tags=["Authentication Endpoints"])
+
+def init_clients():
+    """Create the database, payment and HTTP clients and everything built on them."""
+    global repository, write_behind_queue, quota, conversation_store, client, google_http_client
+    global chat_client_pool, context_builder, title_generator
+
+    # DATA_BACKEND=memory keeps every collection in process memory, used to run and load-test the endpoints offline
+    if get_environment_variable("DATA_BACKEND") == "memory":
+        repository = InMemoryRepository()
+    else:
+        import firebase_admin
+        from firebase_admin import credentials
+        from firebase_admin import firestore_async
+        from firestore_repository import FirestoreRepository
+
+        # Initialize a Firestore client with a specific service account key file
+        if get_environment_variable("ENVIRONMENT") == "dev":
+            cred = credentials.Certificate("serviceAccount.json")
+            firebase_admin.initialize_app(cred)
+        else:
+            firebase_admin.initialize_app()
+
+        repository = FirestoreRepository(firestore_async.client())
+
+    repository = TimedRepository(repository, lambda collection, operation, seconds: firestore_operation_seconds.labels(collection, operation).observe(seconds))
+
+    # Chat turn writes are queued and committed in batches after the response has been sent
+    write_behind_queue = WriteBehindQueue(repository)
+
+    # Generations are reserved before a turn and refunded if it fails, with a short-lived per-user cache
+    quota = QuotaManager(repository, write_behind_queue)
+
+    # Recently active conversations, so clients can send only chat_id and the new user_input
+    conversation_store = ConversationStore(repository, write_behind_queue)
+
+    import razorpay
+    client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+
+    # Keep-alive client for the Google userinfo endpoint
+    google_http_client = httpx.AsyncClient(timeout=10)
+
+    # Provider chat clients are reused across requests so warm keep-alive connections skip the TLS handshake
+    chat_client_pool = ChatClientPool()
+
+    # Titles and summaries wait behind user calls for the scheduler, respect the circuit breakers and are priced like chat calls
+    background_caller = BackgroundCaller(chat_client_pool, model_company_mapping, scheduler, circuit_breakers, record_background_call)
+
+    # Keeps the history within each model's context window, folding older turns into a rolling summary
+    context_builder = ContextBuilder(repository, write_behind_queue, background_caller, model_company_mapping, SUMMARY_MODEL)
+
+    title_generator = TitleGenerator(background_caller, update_chat_title, TITLE_MODEL)
+
+
+
+
+@router.get("/verify", tags=["Authentication Endpoints"])
 async def verify_token_info(token_info: dict = Depends(verify_token)):
     """Verify the JWT token and return the user info."""
     return {"token_info": token_info}
 
 
-@app.post("/v1/chat_event_streaming", tags=["AI Endpoints"])
-async def chat_event_streaming(request: ChatRequest, token_info: dict = Depends(verify_token)):
+@router.post("/v1/chat_event_streaming", tags=["AI Endpoints"])
+async def chat_event_streaming(request: ChatRequest, http_request: Request, token_info: dict = Depends(verify_token)):
     """Chat Event Streaming endpoint for the OpenAI chatbot."""
+    # the phases are sent in a Server-Timing header, and in full after the final frame when asked for with X-Request-Timing
+    timings = request_timings(http_request)
+    setup_started = time.perf_counter()
+    send_timings = http_request.headers.get("X-Request-Timing") == "true"
+    profile = None
+    if profiler.should_profile(http_request.headers.get("X-Profile")):
+        profile = profiler.start(f"{request.chat_model} {token_info['sub']}")
+        send_timings = True
+
+    # the breaker that let this request through, a half-open one holds its probe for it until the call starts
+    probe_breaker = None
+
+    def release_probe():
+        nonlocal probe_breaker
+        if probe_breaker is not None:
+            probe_breaker.record_cancelled()
+            probe_breaker = None
+
+    # the generation reserved for the turn until it is saved, and the scheduler slot of the call
+    reserved = False
+    ticket = None
+
+    def release_held():
+        """Give back what the request still holds when it ends without the stream saving the turn, or never streams."""
+        nonlocal reserved
+        if reserved:
+            reserved = False
+            quota.refund(token_info['sub'])
+        if ticket is not None:
+            ticket.release()
+        release_probe()
+        profiler.stop(profile)
+
     try:
         # Get the chat model from the request and create the corresponding chat instance
         chat_model = request.chat_model
@@ -652,20 +947,27 @@ async def chat_event_streaming(request: ChatRequest, token_info: dict = Depends(
 
         if not chat_config:
             raise ValueError(f"Invalid chat model: {chat_model}")
+
+        # Fail fast while the provider is unhealthy, or route to the equivalent model of a healthy provider.
+        # The call is admitted here, before the response starts, so a lost half-open probe is still a 503
+        routed_from = None
+        breaker = circuit_breakers.get(chat_config['provider'])
+        if not breaker.allow():
+            hedge_model = chat_config.get('hedge_model')
+            breaker = circuit_breakers.get(model_company_mapping[hedge_model]['provider']) if hedge_model else None
+            if breaker is None or not breaker.allow():
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail=f"{chat_config['provider']} is currently unavailable, please try another model",
+                    headers={"Retry-After": "30"},
+                )
+            routed_from, chat_model = chat_model, hedge_model
+            chat_config = model_company_mapping[chat_model]
+        probe_breaker = breaker
         
-        # check the number of generations left for the user
-        generations_left = get_generations(token_info)
-        if generations_left == 0:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Generations limit exceeded",
-            )
-        
-        chat = chat_config['model'](
-            model_name=chat_model,
-            model=chat_model,
-            temperature=request.temperature,
-        )
+        chat_id, is_new_chat, turn_count = await resolve_chat_id(request, token_info['sub'])
+
+        chat = chat_client_pool.get(chat_config['model'], chat_model, request.temperature)
 
 
         prompt = ChatPromptTemplate(
@@ -675,32 +977,135 @@ async def chat_event_streaming(request: ChatRequest, token_info: dict = Depends(
                 HumanMessagePromptTemplate.from_template("{user_input}"),
             ]
         )
-        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-        parser = StrOutputParser()
 
-        conversation = prompt | chat | parser
+        # Stream raw message chunks rather than parsed strings so provider usage metadata is not dropped
+        conversation = prompt | chat
 
-        # Seed the chat history with the user's input from the request
-        for chat_history in request.chat_history:
-            memory.chat_memory.add_user_message(chat_history.user_message)
-            memory.chat_memory.add_ai_message(chat_history.ai_message)
+        # Seed the chat history from the request or the server-side conversation store, within the model's token budget
+        turns = await get_request_turns(request, chat_id, is_new_chat, turn_count)
+        history_messages = await context_builder.build(None if is_new_chat else chat_id, turns, request.user_input, chat_model)
         
         generated_ai_message = ""
 
         # convert into a total input string
-        total_input = prompt.format(chat_history=memory.buffer, user_input=request.user_input)
-        
-        # Run the conversation.invoke method in a separate thread
-        def event_streaming():
-            nonlocal generated_ai_message
+        total_input = prompt.format(chat_history=history_messages, user_input=request.user_input)
+
+        # Output tokens are metered per chunk, the prompt is only tokenized if the provider reports no usage
+        meter = token_counter.StreamMeter(chat_model, chat_config['company'])
+        estimated_tokens = len(total_input) // 4 + ESTIMATED_OUTPUT_TOKENS
+
+        # Deterministic prompts seen before are replayed from the response cache
+        cache_key = None
+        if ENABLE_RESPONSE_CACHE and response_cache.is_cacheable(request.temperature):
+            cache_key = response_cache.key(chat_model, request.temperature, history_messages, request.user_input)
+        cached_chunks = response_cache.get(cache_key) if cache_key else None
+        chunks = []
+
+        # when the response started streaming and when each called model produced its first token, for the metrics
+        stream_started = None
+        first_token_times = {}
+
+        async def provider_tokens(conversation, meter, breaker):
+            # every call reports its outcome and time to first token to the breaker that admitted it
+            started = time.monotonic()
+            first_token = True
             try:
-                for token in conversation.stream({"chat_history": memory.buffer, "user_input": request.user_input}):
-                    generated_ai_message += token
-                    response = ChatEventStreaming(event="stream", data=token, is_final=False)
-                    yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
-                
-                
-                input_token_length, output_token_length, cost = calculate_cost(total_input, generated_ai_message, chat_model)
+                meter.start(total_input)
+                async for chunk in conversation.astream({"chat_history": history_messages, "user_input": request.user_input}):
+                    token = chunk.content if isinstance(chunk.content, str) else ""
+                    meter.add_chunk(token, getattr(chunk, "usage_metadata", None))
+                    if token:
+                        if first_token:
+                            first_token_times[meter.model_name] = time.monotonic()
+                            breaker.record_success(first_token_times[meter.model_name] - started)
+                            time_to_first_token_seconds.labels(meter.model_name, meter.company).observe(first_token_times[meter.model_name] - started)
+                            first_token = False
+                        yield token
+                if first_token:
+                    breaker.record_success(time.monotonic() - started)
+            except (asyncio.CancelledError, GeneratorExit):
+                if first_token:
+                    breaker.record_cancelled()
+                raise
+            except Exception:
+                breaker.record_failure()
+                chat_requests.labels(meter.model_name, meter.company, "failed").inc()
+                raise
+
+        # The equivalent model raced against a slow first token, with its own meter and scheduler slot
+        hedge_result = HedgeResult()
+        hedge = {}
+
+        def start_hedge():
+            hedge_model = chat_config['hedge_model']
+            hedge_config = model_company_mapping[hedge_model]
+            hedge_breaker = circuit_breakers.get(hedge_config['provider'])
+            if not hedge_breaker.allow():
+                return None
+            # a hedge never queues, it only helps if its provider has room right now
+            hedge_ticket = scheduler.try_acquire(hedge_config['provider'], hedge_model, estimated_tokens)
+            if hedge_ticket is None:
+                hedge_breaker.record_cancelled()
+                return None
+            hedge_chat = chat_client_pool.get(hedge_config['model'], hedge_model, request.temperature)
+            hedge.update(model=hedge_model, meter=token_counter.StreamMeter(hedge_model, hedge_config['company']), ticket=hedge_ticket)
+            return provider_tokens(prompt | hedge_chat, hedge['meter'], hedge_breaker)
+
+        async def generate_tokens():
+            nonlocal probe_breaker
+            if cached_chunks is not None:
+                # no provider call, the admitted probe is not needed
+                release_probe()
+                for token in cached_chunks:
+                    yield token
+                return
+            # the call owns the probe from here and reports its outcome
+            probe_breaker = None
+            if not (ENABLE_HEDGING and 'hedge_model' in chat_config):
+                async for token in provider_tokens(conversation, meter, breaker):
+                    yield token
+                return
+            async for token in hedged_stream(provider_tokens(conversation, meter, breaker), start_hedge, HEDGE_TTFT_SECONDS, hedge_result):
+                yield token
+        
+        def record_stream_metrics(model_name, input_token_length, output_token_length, cost, disconnected):
+            """Count the tokens and cost of a call, and time the stream of the one that answered (disconnected is None for the other)."""
+            company = model_company_mapping[model_name]['company']
+            chat_input_tokens.labels(model_name, company).inc(input_token_length)
+            chat_output_tokens.labels(model_name, company).inc(output_token_length)
+            chat_cost_dollars.labels(model_name, company).inc(cost)
+            if disconnected is None:
+                return
+            chat_requests.labels(model_name, company, "disconnected" if disconnected else "completed").inc()
+            now = time.monotonic()
+            stream_duration_seconds.labels(model_name, company).observe(now - stream_started)
+            first_token_time = first_token_times.get(model_name)
+            if first_token_time is not None and now > first_token_time and output_token_length:
+                tokens_per_second.labels(model_name, company).observe(output_token_length / (now - first_token_time))
+
+        async def save_turn(disconnected=False):
+            """Meter, price and queue the turn, a disconnected client still gets the partial answer saved."""
+            if cached_chunks is not None:
+                # no provider tokens were used for a cached answer
+                stats = {
+                    "input_token_length": 0,
+                    "output_token_length": 0,
+                    "cost": 0,
+                    "cached": True
+                }
+                chat_requests.labels(chat_model, chat_config['company'], "cached").inc()
+            else:
+                # the model that produced the answer, the hedge model if it won the race
+                calls = [(chat_model, meter, ticket)]
+                if hedge_result.hedged:
+                    calls.append((hedge['model'], hedge['meter'], hedge['ticket']))
+                answer_model, answer_meter, answer_ticket = calls.pop(hedge_result.winner or 0)
+
+                input_token_length, output_token_length = await answer_meter.totals()
+                if answer_ticket is not None:
+                    answer_ticket.release(input_token_length + output_token_length)
+                with timings.measure("cost"):
+                    cost = calculate_cost(input_token_length, output_token_length, answer_model)
 
                 # stats for the chat
                 stats = {
@@ -708,61 +1113,287 @@ async def chat_event_streaming(request: ChatRequest, token_info: dict = Depends(
                     "output_token_length": output_token_length,
                     "cost": cost
                 }
-                # Database update after streaming is completed
-                chat_id = add_message_to_db(request, token_info['sub'], request.user_input, generated_ai_message, stats)
-
-                # update the remaining generations for the user
-                update_generations_left(token_info, generations_left)
-
-                response = ChatEventStreaming(event="stream", data="", is_final=True, chat_id=chat_id)
-                yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
-            except uvicorn.protocols.utils.ClientDisconnected:
+                if hedge_result.hedged:
+                    # the cancelled call is paid for too, cost is the total of both
+                    loser_model, loser_meter, loser_ticket = calls[0]
+                    loser_input_token_length, loser_output_token_length = await loser_meter.totals()
+                    loser_ticket.release(loser_input_token_length + loser_output_token_length)
+                    with timings.measure("cost"):
+                        hedge_cost = calculate_cost(loser_input_token_length, loser_output_token_length, loser_model)
+                    stats.update({
+                        "cost": cost + hedge_cost,
+                        "answered_by": answer_model,
+                        "hedge_model": hedge['model'],
+                        "hedge_cost": hedge_cost
+                    })
+                if routed_from:
+                    stats.update({
+                        "answered_by": answer_model,
+                        "routed_from": routed_from
+                    })
+                disconnect_monitor.record(answer_model, output_token_length, disconnected)
+                record_stream_metrics(answer_model, input_token_length, output_token_length, cost, disconnected)
+                if hedge_result.hedged:
+                    record_stream_metrics(loser_model, loser_input_token_length, loser_output_token_length, hedge_cost, None)
+                if cache_key and not disconnected and answer_model == chat_model:
+                    response_cache.set(cache_key, chunks)
+            if disconnected:
+                stats["disconnected"] = True
+
+            # Database update after streaming is completed, committed in the background by the write-behind queue
+            with timings.measure("db"):
+                add_message_to_db(request, chat_id, is_new_chat, token_info['sub'], request.user_input, generated_ai_message, stats)
+                if WEB_CONCURRENCY > 1:
+                    # the next request of the chat can reach another worker, it must find the chat and this turn
+                    await write_behind_queue.wait_flushed()
+            if is_new_chat:
+                # title the chat from its first turn while the client renders the answer
+                title_generator.schedule(chat_id, [(request.user_input, generated_ai_message)])
+
+            # keep the generation reserved for this turn
+            quota.commit(token_info['sub'])
+
+        # Stream the conversation on the event loop so that each open stream holds a socket, not a threadpool thread
+        async def event_streaming():
+            nonlocal generated_ai_message, stream_started, reserved
+            stream_started = time.monotonic()
+            saved = False
+            # Done when the client goes away, which cancels the upstream call
+            disconnected = asyncio.get_running_loop().create_future()
+            disconnect_monitor.start(http_request, disconnected)
+            try:
+                async for token in sse.coalesce(generate_tokens(), SSE_COALESCE_MS / 1000, SSE_COALESCE_CHARS, stop=disconnected):
+                    chunks.append(token)
+                    generated_ai_message += token
+                    yield sse.encode_token(token)
+
+                # time to the first token of the answering model, then the rest of the stream
+                stream_ended = time.monotonic()
+                first_token_time = min(first_token_times.values(), default=stream_started)
+                timings.add("first_token", first_token_time - stream_started)
+                timings.add("streaming", stream_ended - first_token_time)
+
+                if disconnected.done():
+                    logging.info("Client disconnected, upstream generation cancelled.")
+                    if generated_ai_message:
+                        await save_turn(disconnected=True)
+                        saved = True
+                    return
+
+                await save_turn()
+                saved = True
+
+                yield sse.encode_final(chat_id)
+
+                for phase, seconds in timings.phases.items():
+                    request_phase_seconds.labels(phase).observe(seconds)
+                if send_timings:
+                    yield sse.encode_event("timing", timings.as_dict())
+            except (uvicorn.protocols.utils.ClientDisconnected, asyncio.CancelledError, GeneratorExit):
+                # The server cancels or closes the stream when it sees the disconnect first, awaits here would be cancelled too
                 logging.info("Client disconnected.")
-                response = ChatEventStreaming(event="stream", data="", is_final=True)
-                yield f"data: {json.dumps(jsonable_encoder(response))}\n\n"
-
+                if not saved and generated_ai_message:
+                    disconnect_monitor.spawn(save_turn(disconnected=True))
+                    saved = True
+                raise
+            finally:
+                if not disconnected.done():
+                    disconnected.cancel()
+                if not saved:
+                    for call_ticket in (ticket, hedge.get('ticket')):
+                        if call_ticket is not None:
+                            call_ticket.release()
+                if saved:
+                    # save_turn commits the reserved generation
+                    reserved = False
+                else:
+                    meter.cancel()
+                    # the turn was not saved, give the reserved generation back
+                    release_held()
+
+
+        timings.add("model_setup", time.perf_counter() - setup_started)
+
+        # reserve one of the generations left for the user, atomically
+        with timings.measure("quota"):
+            reserved = await quota.reserve(token_info['sub'])
+        if not reserved:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Generations limit exceeded",
+            )
 
-        return StreamingResponse(event_streaming(), media_type="text/event-stream")
+        # wait for the provider and model budgets, cached answers do not call the provider
+        if cached_chunks is None:
+            priority = PAID if await is_paid_user(token_info['sub']) else FREE
+            try:
+                with timings.measure("queue"):
+                    ticket = await scheduler.acquire(chat_config['provider'], chat_model, token_info['sub'], estimated_tokens, priority)
+            except QueueTimeout as e:
+                # the generation is given back by the handler below
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="The model is busy, please try again shortly",
+                    headers={"Retry-After": "5"},
+                ) from e
+
+        # the slot, probe and generation are also given back if the stream never starts, e.g. the client left first
+        return StreamingResponse(
+            event_streaming(),
+            media_type="text/event-stream",
+            headers={"Server-Timing": timings.server_timing()},
+            background=BackgroundTask(release_held),
+        )
     except ValidationError as ve:
         # Handle validation errors specifically for better user feedback
         logging.error("Validation error: %s", ve)
+        release_held()
         raise HTTPException(status_code=400, detail="Invalid request data") from ve
     except HTTPException as he:
         # Handle HTTP exceptions specifically for better user feedback
+        release_held()
         raise he
     except Exception as e:
         # Log and handle generic exceptions gracefully
         logging.error("Error processing chat request: %s", e)
+        release_held()
         raise HTTPException(status_code=500, detail="Internal server error") from e
+    except BaseException:
+        # cancelled, e.g. while queued for the scheduler when the client goes away
+        release_held()
+        raise
+
+
+
+@router.get("/v1/stats", tags=["Internal Endpoints"])
+async def internal_stats(token_info: dict = Depends(verify_token)):
+    """Get the runtime stats of the shared server components."""
+    return {
+        "chat_client_pool": chat_client_pool.stats(),
+        "write_behind_queue": write_behind_queue.stats(),
+        "quota": quota.stats(),
+        "google_token_cache": google_token_cache.stats(),
+        "known_users_cache": known_users_cache.stats(),
+        "jwt_claims_cache": jwt_claims_cache.stats(),
+        "chat_history_page_cursors": chat_history_page_cursors.stats(),
+        "conversation_store": conversation_store.stats(),
+        "context_builder": context_builder.stats(),
+        "response_cache": response_cache.stats(),
+        "title_generator": title_generator.stats(),
+        "disconnects": disconnect_monitor.stats(),
+        "scheduler": scheduler.stats(),
+        "circuit_breakers": circuit_breakers.stats(),
+        "paid_users_cache": paid_users_cache.stats(),
+    }
+
 
+@router.get("/v1/profiles", tags=["Internal Endpoints"])
+async def list_profiles(x_profile: Optional[str] = Header(None)):
+    """List the kept request profiles of this worker process, requires the profiler admin token in X-Profile."""
+    if not profiler.is_admin(x_profile):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Profiler admin token required")
+    return profiler.summaries()
+
+
+@router.get("/v1/profiles/{profile_id}", tags=["Internal Endpoints"])
+async def get_profile(profile_id: int, x_profile: Optional[str] = Header(None)):
+    """Get a request profile as folded stacks, for flamegraph.pl or speedscope."""
+    if not profiler.is_admin(x_profile):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Profiler admin token required")
+    folded = profiler.folded(profile_id)
+    if folded is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    return Response(content=folded, media_type="text/plain")
+
+
+@router.get("/metrics", tags=["Internal Endpoints"])
+async def prometheus_metrics():
+    """Prometheus metrics of the server, summed over the worker processes when they share METRICS_DIR."""
+    content = await asyncio.to_thread(metrics.REGISTRY.render, METRICS_DIR) if METRICS_DIR else metrics.REGISTRY.render()
+    return Response(content=content, media_type=metrics.CONTENT_TYPE)
+
+
+@router.get("/v1/models/health", tags=["AI Endpoints"])
+async def models_health(token_info: dict = Depends(verify_token)):
+    """Get the health of the serving provider of every model, so the model picker can grey out unavailable ones."""
+    providers = {provider: circuit_breakers.get(provider).health() for provider in {config['provider'] for config in model_company_mapping.values()}}
+    return {
+        "models": {
+            model_name: {"company": config['company'], "provider": config['provider'], "available": providers[config['provider']]['available']}
+            for model_name, config in model_company_mapping.items()
+        },
+        "providers": providers,
+    }
 
 
-@app.get("/v1/generations", tags=["AI Endpoints"])
+@router.get("/v1/generations", tags=["AI Endpoints"])
 async def get_generations_left(token_info: dict = Depends(verify_token)):
     """Get the number of generations left for the user."""
     try:
-        generations_left = get_generations(token_info)
+        generations_left = await get_generations(token_info)
         return {"generations_left": generations_left}
     except Exception as e:
         logging.error("Error processing generations request: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
+
+# Largest page the paginated endpoints return, limit is validated against it
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(start_after):
+    """Encode the (timestamp, document_id) of the last item of a page into an opaque cursor."""
+    timestamp, document_id = start_after
+    return base64.urlsafe_b64encode(json.dumps([timestamp.isoformat(), document_id]).encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    """Decode an opaque cursor back into (timestamp, document_id)."""
+    try:
+        timestamp, document_id = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        return datetime.datetime.fromisoformat(timestamp), document_id
+    except (binascii.Error, TypeError, ValueError) as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        ) from exc
+
+
 # chat history of the user
-@app.get("/v1/chat_history", tags=["AI Endpoints"], response_model=list[ChatUserHistory])
-async def user_chat_history(page: int = 1, limit: int = 10, token_info: dict = Depends(verify_token)):
-    """Chat history endpoint for the OpenAI chatbot."""
+@router.get("/v1/chat_history", tags=["AI Endpoints"], response_model=list[ChatUserHistory])
+async def user_chat_history(response: Response, page: int = Query(1, ge=1), limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, token_info: dict = Depends(verify_token)):
+    """
+    Chat history endpoint for the OpenAI chatbot.
+    Pass the X-Next-Cursor response header back as cursor to get the next page, page is kept for compatibility.
+    """
     try:
-        # Calculate the starting index based on the page and limit
-        start_index = (page - 1) * limit
+        offset = 0
+        if cursor:
+            start_after = decode_cursor(cursor)
+        elif page > 1:
+            # Reuse the cursor of the previous page when the pages are fetched in order, otherwise fall back to the offset
+            start_after = chat_history_page_cursors.get((token_info['sub'], limit, page))
+            if start_after is None:
+                offset = (page - 1) * limit
+        else:
+            start_after = None
+
+        # Get the chat history from the database with pagination, one extra chat tells whether there is a next page
+        chats = await repository.list_chats(token_info['sub'], limit + 1, offset=offset, start_after=start_after)
 
-        # Get the chat history from the database with pagination
         chat_history = []
-        chat_ref = db.collection('chats').where('google_user_id', '==', token_info['sub']).order_by('updated_at', direction=google_firestore.Query.DESCENDING).offset(start_index).limit(limit).stream()
-        for chat_data in chat_ref:
-            chat_data = chat_data.to_dict()
+        for chat_data in chats[:limit]:
             chat_history.append(ChatUserHistory(chat_id=chat_data['chat_id'], created_at=chat_data['created_at'], updated_at=chat_data['updated_at'], chat_title=chat_data.get('chat_title', None) , chat_model=chat_data.get('model', 'gpt-3.5-turbo')))
+
+        if len(chats) > limit:
+            next_start_after = (chat_history[-1].updated_at, chat_history[-1].chat_id)
+            response.headers["X-Next-Cursor"] = encode_cursor(next_start_after)
+            if not cursor:
+                chat_history_page_cursors.set((token_info['sub'], limit, page + 1), next_start_after)
                     
         return chat_history
+    except HTTPException as he:
+        raise he
     except Exception as e:
         # Log and handle generic exceptions gracefully
         logging.error("Error processing chat history request: %s", e)
@@ -772,67 +1403,56 @@ async def user_chat_history(page: int = 1, limit: int = 10, token_info: dict = D
 
 def update_chat_title(chat_id, new_chat_title):
     """
-    Background task to update the chat title in the database.
+    Queue the update of the chat title in the database.
     """
     try:
-        chat_doc_ref = db.collection('chats').document(chat_id)
-        chat_doc_ref.update({
+        # Goes through the write-behind queue so it is ordered after a chat creation that is not flushed yet
+        write_behind_queue.enqueue([Write('update', 'chats', chat_id, {
             'chat_title': new_chat_title,
-            'updated_at': google_firestore.SERVER_TIMESTAMP,
-        })
+        })])
     except Exception as e:
         logging.error(f'Error updating chat title: {e}')
 
 
+# Longest time GET /v1/chat_title waits for a title in progress
+CHAT_TITLE_MAX_WAIT = 30
+
+# How often GET /v1/chat_title reads a title generated by another worker while it waits
+CHAT_TITLE_POLL_SECONDS = 0.5
+
 
 # title of the chat generater
-@app.post("/v1/chat_title", tags=["AI Endpoints"])
-async def chat_title(request: ChatRequest, token_info: dict = Depends(verify_token)):
-    """Chat endpoint for the OpenAI chatbot."""
+@router.post("/v1/chat_title", tags=["AI Endpoints"])
+async def chat_title(request: ChatRequest, response: Response, token_info: dict = Depends(verify_token)):
+    """
+    Start generating the title of a chat and return immediately.
+    Returns 202 while the title is being generated, fetch it with GET /v1/chat_title/{chat_id}.
+    """
     try:
-        # Get the chat model from the request and create the corresponding chat instance
-        chat_config = model_company_mapping.get("gpt-4o-mini")
-
         # check the number of generations left for the user
-        generations_left = get_generations(token_info)
-        if generations_left == 0:
+        generations_left = await get_generations(token_info)
+        if generations_left <= 0:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="Generations limit exceeded",
             )
-        
-        chat = chat_config['model'](
-            model_name="gpt-4o-mini",
-            model="gpt-4o-mini",
-            temperature=request.temperature,
-        )
-
-
-        prompt = ChatPromptTemplate(
-            messages=[
-                # SystemMessagePromptTemplate.from_template(""),
-                MessagesPlaceholder(variable_name="chat_history"),
-                HumanMessagePromptTemplate.from_template("{user_input}"),
-            ]
-        )
-        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-        conversation = LLMChain(llm=chat, memory=memory, prompt=prompt, verbose=False)
-
-        # Seed the chat history with the user's input from the request
-        for chat_history in request.chat_history:
-            memory.chat_memory.add_user_message(chat_history.user_message)
-            memory.chat_memory.add_ai_message(chat_history.ai_message)
-
-        # Run the conversation.invoke method in a separate thread
-        response = conversation.invoke(input="Generate a concise and relevant 5-word title for the above chat based on the main topic discussed. Do not include any creative or ambiguous terms.")
 
-        # clean the response of extra "" or /
-        response["text"] = response["text"].replace('"', '').replace("/", "")
+        # verify that chat_id belongs to the user before a title is written to it
+        chat_id, is_new_chat, turn_count = await resolve_chat_id(request, token_info['sub'])
+        if is_new_chat:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Chat not found",
+            )
 
-        # Database update after streaming is completed
-        update_chat_title(request.chat_id, response["text"])
+        title = await title_generator.wait(chat_id, 0)
+        if title is None:
+            # Only the start of the chat is needed for a title, duplicate requests join the generation in progress
+            turns = await get_request_turns(request, chat_id, is_new_chat, turn_count)
+            title_generator.schedule(chat_id, turns)
+            response.status_code = status.HTTP_202_ACCEPTED
 
-        return ChatResponse(response=response["text"])
+        return ChatResponse(response=title or "")
     except ValidationError as ve:
         # Handle validation errors specifically for better user feedback
         logging.error("Validation error: %s", ve)
@@ -846,40 +1466,128 @@ async def chat_title(request: ChatRequest, token_info: dict = Depends(verify_tok
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
 
+@router.get("/v1/chat_title/{chat_id}", tags=["AI Endpoints"])
+async def get_chat_title(chat_id: str, response: Response, wait: float = 0, token_info: dict = Depends(verify_token)):
+    """
+    Get the title of a chat. Pass wait (seconds) to be answered as soon as a title in progress is generated.
+    Returns 202 with an empty title while it is still being generated.
+    """
+    try:
+        chat_data = write_behind_queue.pending('chats', chat_id) or await repository.get_chat(chat_id)
+        if not chat_data:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Chat not found",
+            )
+        if chat_data['google_user_id'] != token_info['sub']:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Forbidden",
+            )
+
+        wait = min(max(wait, 0), CHAT_TITLE_MAX_WAIT)
+        deadline = time.monotonic() + wait
+        title = await title_generator.wait(chat_id, wait)
+        if title is None:
+            title = chat_data.get('chat_title')
+        # With several workers the title can be generated by another one, it is read through the repository until the deadline
+        while title is None and WEB_CONCURRENCY > 1 and not title_generator.is_pending(chat_id) and time.monotonic() < deadline:
+            await asyncio.sleep(min(CHAT_TITLE_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+            title = ((await repository.get_chat(chat_id)) or {}).get('chat_title')
+        if title is None and (title_generator.is_pending(chat_id) or WEB_CONCURRENCY > 1):
+            response.status_code = status.HTTP_202_ACCEPTED
+        elif write_behind_queue.is_pending('chats', chat_id):
+            # so the chat list fetched next already shows the new title
+            await write_behind_queue.wait_flushed()
+
+        return ChatResponse(response=title or "")
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logging.error("Error fetching chat title: %s", e)
+        raise HTTPException(status_code=500, detail="Internal server error") from e
+
+
+# Number of chat_history documents read per query when streaming a whole chat
+CHAT_HISTORY_PAGE_SIZE = 50
+
+
 # chats by chat_id
-@app.get("/v1/chat_by_id", tags=["AI Endpoints"], response_model=list[ChatByIdHistory])
-async def chat_by_id(chat_id: str, token_info: dict = Depends(verify_token)):
-    """Chat endpoint for the OpenAI chatbot."""
+@router.get("/v1/chat_by_id", tags=["AI Endpoints"], response_model=list[ChatByIdHistory])
+async def chat_by_id(chat_id: str, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, if_none_match: Optional[str] = Header(None), token_info: dict = Depends(verify_token)):
+    """
+    Chat endpoint for the OpenAI chatbot.
+    Messages are streamed in created_at order. Pass limit to get a single page, and the X-Next-Cursor
+    response header back as cursor for the next one. Unchanged chats return 304 for a matching If-None-Match.
+    """
     try:
+        # A turn still in the write-behind queue must be visible to the chat it belongs to
+        if write_behind_queue.is_pending('chats', chat_id):
+            await write_behind_queue.wait_flushed()
+
         # verify that chat_id belongs to the user using google_user_id inside token_info['sub']
-        chat_ref = db.collection('chats').where('chat_id', '==', chat_id).stream()
-        chat_data = next(chat_ref, None)
+        chat_data = await repository.get_chat(chat_id)
 
-        if chat_data:
-            chat_data = chat_data.to_dict()
-            if chat_data['google_user_id'] == token_info['sub']:
-                chat_history = []
-                chat_history_ref = db.collection('chat_history').where('chat_id', '==', chat_id).stream()
-                for chat_data in chat_history_ref:
-                    chat_data = chat_data.to_dict()
-                    chat_history.append(ChatByIdHistory(ai_message=chat_data['ai_message'], user_message=chat_data['user_message'], created_at=chat_data['created_at'], updated_at=chat_data['updated_at'], regenerate_message=chat_data['regenerate_message'], model=chat_data['model']))
-                return chat_history
-            else:
-                raise HTTPException(
-                    status_code=status.HTTP_403_FORBIDDEN,
-                    detail="Forbidden",
-                )
-        else:
+        if not chat_data:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Chat not found",
             )
+        if chat_data['google_user_id'] != token_info['sub']:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Forbidden",
+            )
+
+        # Every new message updates the chat, so its updated_at versions the whole history
+        etag_source = f"{chat_id}|{chat_data['updated_at'].isoformat()}|{limit}|{cursor}"
+        etag = f'W/"{hashlib.sha256(etag_source.encode("utf-8")).hexdigest()[:32]}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if if_none_match == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        start_after = decode_cursor(cursor) if cursor else None
+        if limit:
+            # Single page, one extra message tells whether there is a next page
+            chat_history_page = await repository.list_chat_history(chat_id, limit + 1, start_after=start_after)
+            if len(chat_history_page) > limit:
+                chat_history_page = chat_history_page[:limit]
+                last_document_id, last_chat_data = chat_history_page[-1]
+                headers["X-Next-Cursor"] = encode_cursor((last_chat_data['created_at'], last_document_id))
+
+        async def chat_history_pages():
+            if limit:
+                yield chat_history_page
+                return
+            page_start_after = start_after
+            while True:
+                page = await repository.list_chat_history(chat_id, CHAT_HISTORY_PAGE_SIZE, start_after=page_start_after)
+                if page:
+                    yield page
+                if len(page) < CHAT_HISTORY_PAGE_SIZE:
+                    return
+                last_document_id, last_chat_data = page[-1]
+                page_start_after = (last_chat_data['created_at'], last_document_id)
+
+        # Stream the JSON array page by page instead of building every message in memory
+        async def stream_chat_history():
+            separator = "["
+            async for page in chat_history_pages():
+                for _, chat_data in page:
+                    message = ChatByIdHistory(ai_message=chat_data['ai_message'], user_message=chat_data['user_message'], created_at=chat_data['created_at'], updated_at=chat_data['updated_at'], regenerate_message=chat_data['regenerate_message'], model=chat_data['model'])
+                    yield separator + json.dumps(jsonable_encoder(message))
+                    separator = ","
+            yield "[]" if separator == "[" else "]"
+
+        return StreamingResponse(stream_chat_history(), media_type="application/json", headers=headers)
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logging.error("Error processing chat request: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
 
-@app.post("/v1/create_order", tags=["Order Endpoints"])
+@router.post("/v1/create_order", tags=["Order Endpoints"])
 async def create_order(plan_id: str, token_info: dict = Depends(verify_token)):
     """Create an order for the user."""
     try:
@@ -910,14 +1618,12 @@ async def create_order(plan_id: str, token_info: dict = Depends(verify_token)):
         }
 
     
-        order = Order(client).create(order_data)
+        order = client.order.create(order_data)
         # save the order into the orders collection
-        db.collection('orders').add({
+        await repository.add_order({
             'order_id': order['id'],
             'plan_id': plan_id,
             'customer_id': token_info['sub'],
-            'created_at': google_firestore.SERVER_TIMESTAMP,
-            'updated_at': google_firestore.SERVER_TIMESTAMP,
         })
 
         response = {
@@ -936,7 +1642,7 @@ async def create_order(plan_id: str, token_info: dict = Depends(verify_token)):
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
 
-@app.post("/v1/verify_payment", tags=["Order Endpoints"])
+@router.post("/v1/verify_payment", tags=["Order Endpoints"])
 async def verify_payment(request: PaymentRequest, token_info: dict = Depends(verify_token)):
     """Verify the payment for the user."""
     
@@ -948,8 +1654,7 @@ async def verify_payment(request: PaymentRequest, token_info: dict = Depends(ver
             )
 
         # first check if the payment_id exists in the payments collection
-        payment_ref = db.collection('payments').where('payment_id', '==', request.razorpay_payment_id).stream()
-        payment_data = next(payment_ref, None)
+        payment_data = await repository.find_payment(request.razorpay_payment_id)
 
         if payment_data:
             raise HTTPException(
@@ -970,37 +1675,25 @@ async def verify_payment(request: PaymentRequest, token_info: dict = Depends(ver
                 detail="Invalid signature",
             )
 
-        order_data = Order(client).fetch(request.razorpay_order_id)
+        order_data = client.order.fetch(request.razorpay_order_id)
         # check if the order is paid
         if order_data['status'] == 'paid':
-            
-            db.collection('payments').add({
-                'order_id': request.razorpay_order_id,
-                'payment_id': request.razorpay_payment_id,
-                'customer_id': token_info['sub'],
-                'created_at': google_firestore.SERVER_TIMESTAMP,
-                'updated_at': google_firestore.SERVER_TIMESTAMP,
-            })
-
-            # get the current remaining generations for the user
-            generations_left = get_generations(token_info)
-
-            # update user_generations collection by adding the remaining generations
-            if order_data['receipt'] == 'plan_50':
-                db.collection('user_generations').document(token_info['sub']).update({
-                    'remaining_generations': 50 + generations_left,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                })
-            elif order_data['receipt'] == 'plan_250':
-                db.collection('user_generations').document(token_info['sub']).update({
-                    'remaining_generations': 250 + generations_left,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                })
-            elif order_data['receipt'] == 'plan_500':
-                db.collection('user_generations').document(token_info['sub']).update({
-                    'remaining_generations': 500 + generations_left,
-                    'updated_at': google_firestore.SERVER_TIMESTAMP,
-                })
+            generations = {'plan_50': 50, 'plan_250': 250, 'plan_500': 500}.get(order_data['receipt'], 0)
+
+            # the payment document is keyed by payment_id and created in the same batch as the credit,
+            # so concurrent verifications of one payment credit it once
+            try:
+                await quota.credit(token_info['sub'], generations, [Write('create', 'payments', request.razorpay_payment_id, {
+                    'order_id': request.razorpay_order_id,
+                    'payment_id': request.razorpay_payment_id,
+                    'customer_id': token_info['sub'],
+                })])
+            except DocumentExists as e:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Payment already exists",
+                ) from e
+            paid_users_cache.set(token_info['sub'], True)
 
             return {"status": "success"}
         else:
@@ -1015,7 +1708,7 @@ async def verify_payment(request: PaymentRequest, token_info: dict = Depends(ver
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
 
-@app.get("/v1/fetch_payments", tags=["Order Endpoints"])
+@router.get("/v1/fetch_payments", tags=["Order Endpoints"])
 async def fetch_receipt(token_info: dict = Depends(verify_token)):
     """Fetch the receipt URL for a given payment."""
     try:
@@ -1027,10 +1720,7 @@ async def fetch_receipt(token_info: dict = Depends(verify_token)):
         
         # fetch the receipts for the user sorted by updated_at
         receipts = []
-        receipt_ref = db.collection('payments').where('customer_id', '==', token_info['sub']).order_by('updated_at', direction=google_firestore.Query.DESCENDING).stream()
-
-        for receipt_data in receipt_ref:
-            receipt_data = receipt_data.to_dict()
+        for receipt_data in await repository.list_payments(token_info['sub']):
             # remove the customer_id from the receipt
             receipt_data.pop('customer_id')
             receipts.append(receipt_data)
@@ -1043,7 +1733,7 @@ async def fetch_receipt(token_info: dict = Depends(verify_token)):
         logging.error("Error fetching receipt: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
-@app.get("/v1/fetch_payment/{payment_id}", tags=["Order Endpoints"])
+@router.get("/v1/fetch_payment/{payment_id}", tags=["Order Endpoints"])
 async def fetch_payment(payment_id: str, token_info: dict = Depends(verify_token)):
     """Fetch the receipt URL for a given payment."""
     try:
@@ -1054,12 +1744,11 @@ async def fetch_payment(payment_id: str, token_info: dict = Depends(verify_token
             )
         
         # check if the payment_id exists for that customer_id
-        payment_ref = db.collection('payments').where('payment_id', '==', payment_id).where('customer_id', '==', token_info['sub']).stream()
-        payment_data = next(payment_ref, None)
+        payment_data = await repository.find_payment(payment_id, token_info['sub'])
 
         if payment_data:
             # fetch the payment details
-            payment_data = Payment(client).fetch(payment_id)
+            payment_data = client.payment.fetch(payment_id)
             payment_payload = {
                 "id": payment_data['id'],
                 "order_id": payment_data['order_id'],
@@ -1081,7 +1770,64 @@ async def fetch_payment(payment_id: str, token_info: dict = Depends(verify_token
         logging.error("Error fetching payment: %s", e)
         raise HTTPException(status_code=500, detail="Internal server error") from e
 
-if __name__ == "__main__":
+def create_app():
+    """
+    Build the FastAPI application. Every worker process calls this itself, and the lifespan hook
+    creates the Firestore, Razorpay and HTTP clients inside the worker, so nothing is shared across a fork.
+    """
+    app = FastAPI(lifespan=lifespan)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "ETag", "Server-Timing"],
+    )
+    app.add_exception_handler(Exception, generic_exception_handler)
+    app.add_exception_handler(HTTPException, custom_http_exception_handler)
+    app.include_router(router)
+    return app
+
+
+# Kept for `uvicorn app:app`, which serves a single process
+app = create_app()
+
+
+def serve():
+    """
+    Serve create_app() from WEB_CONCURRENCY worker processes, one by default. With several workers the scheduler
+    budgets are split between them, a turn is flushed to the database before its final frame so the next request finds
+    it on any worker, reservations are transactions on the stored quota, cached conversations are checked against the
+    stored turn count and GET /v1/chat_title reads titles generated by other workers through the repository.
+    With several workers, each is replaced after MAX_REQUESTS_PER_WORKER requests to bound memory growth, 0 disables it.
+    A single worker is never recycled, nothing would restart it.
+    """
+    max_requests = int(get_environment_variable("MAX_REQUESTS_PER_WORKER") or 0)
+    graceful_shutdown_seconds = get_environment_variable("GRACEFUL_SHUTDOWN_SECONDS")
+    if WEB_CONCURRENCY > 1:
+        # The workers already spread token counting across the cores, skip the per-worker tokenizer processes
+        os.environ.setdefault("TOKENIZER_PROCESSES", "0")
+        # Each worker has its own metrics, they are summed from the snapshots the workers write to METRICS_DIR
+        if METRICS_DIR:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+                os.remove(path)
+        else:
+            os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="metrics-")
+    uvicorn.run(
+        "app:create_app",
+        factory=True,
+        host="0.0.0.0",
+        port=int(get_environment_variable("PORT") or 5000),
+        workers=WEB_CONCURRENCY,
+        limit_max_requests=(max_requests or None) if WEB_CONCURRENCY > 1 else None,
+        # a recycled worker finishes its open streams unless GRACEFUL_SHUTDOWN_SECONDS is set
+        timeout_graceful_shutdown=int(graceful_shutdown_seconds) if graceful_shutdown_seconds else None,
+        log_level="info",
+    )
+
 
-    # Use multiprocessing for parallel request handling
-    uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info")
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,72 @@
+"""Model calls made outside of a chat request, e.g. titles and summaries, admitted and accounted for like chat calls."""
+import asyncio
+import time
+
+import token_counter
+from circuit_breaker import CircuitOpenError
+from scheduler import BACKGROUND
+
+# Output tokens assumed for a call until its actual usage is known
+ESTIMATED_OUTPUT_TOKENS = 300
+
+
+class BackgroundCaller:
+    """
+    Invokes a model for a background purpose. The call waits for a BACKGROUND scheduler slot, is refused while the
+    circuit breaker of its provider is open and reports its outcome to it. Its tokens are passed to
+    record(model_name, purpose, outcome, input_tokens, output_tokens) for the cost and metrics.
+    """
+
+    def __init__(self, chat_client_pool, model_company_mapping, scheduler, circuit_breakers, record=None):
+        self.chat_client_pool = chat_client_pool
+        self.model_company_mapping = model_company_mapping
+        self.scheduler = scheduler
+        self.circuit_breakers = circuit_breakers
+        self.record = record
+
+    def _record(self, model_name, purpose, outcome, input_tokens=0, output_tokens=0):
+        if self.record is not None:
+            self.record(model_name, purpose, outcome, input_tokens, output_tokens)
+
+    async def invoke(self, model_name, purpose, messages, temperature=0):
+        """Return the model's answer to messages, raising CircuitOpenError or QueueTimeout when it cannot be called."""
+        config = self.model_company_mapping[model_name]
+        prompt = "\n".join(str(message.content) for message in messages)
+        estimated_tokens = len(prompt) // 4 + ESTIMATED_OUTPUT_TOKENS
+
+        breaker = self.circuit_breakers.get(config['provider'])
+        if not breaker.allow():
+            raise CircuitOpenError(f"{config['provider']} is currently unavailable")
+        try:
+            # queued behind every user call of the provider, per purpose rather than per user
+            ticket = await self.scheduler.acquire(config['provider'], model_name, f"background:{purpose}", estimated_tokens, BACKGROUND)
+        except BaseException:
+            breaker.record_cancelled()
+            raise
+
+        used_tokens = None
+        try:
+            chat = self.chat_client_pool.get(config['model'], model_name, temperature)
+            started = time.monotonic()
+            try:
+                response = await chat.ainvoke(messages)
+            except asyncio.CancelledError:
+                breaker.record_cancelled()
+                raise
+            except Exception:
+                breaker.record_failure()
+                self._record(model_name, purpose, "failed")
+                raise
+            # the whole answer is awaited, its duration stands in for the time to first token
+            breaker.record_success(time.monotonic() - started)
+
+            usage = getattr(response, "usage_metadata", None)
+            if usage:
+                input_tokens, output_tokens = usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+            else:
+                input_tokens, output_tokens = await token_counter.acount_tokens_batch([prompt, str(response.content)], model_name, config['company'])
+            used_tokens = input_tokens + output_tokens
+            self._record(model_name, purpose, "completed", input_tokens, output_tokens)
+            return response
+        finally:
+            ticket.release(used_tokens)
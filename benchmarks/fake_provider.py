@@ -0,0 +1,57 @@
+"""Chat model streaming canned tokens at a configurable time to first token and rate, used by the load test.
+
+Models of model_company_mapping are pointed at it with the class path "fake_provider:FakeChatModel".
+"""
+import asyncio
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+TOKENS = ["Hello", ",", " this", " is", " a", " \"quoted\"", " token", " stream", "\n", " é", " with", " code", " `x`", "."]
+
+# Shared by every instance, set by configure() before the server starts
+SETTINGS = {
+    "ttft": 0.3,
+    "tokens_per_second": 50.0,
+    "output_tokens": 200,
+    # tokens delivered back to back, like providers flushing several tokens per network read
+    "burst": 1,
+}
+
+
+def configure(**settings):
+    SETTINGS.update(settings)
+
+
+class FakeChatModel(BaseChatModel):
+    """Streams SETTINGS["output_tokens"] tokens after SETTINGS["ttft"] seconds and reports its usage on the last chunk."""
+
+    model_name: str = "fake"
+    model: str = "fake"
+    temperature: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake-streaming"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        # used for titles and summaries, answered right away
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="Benchmark chat"))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        output_tokens = SETTINGS["output_tokens"]
+        burst = max(SETTINGS["burst"], 1)
+        interval = burst / SETTINGS["tokens_per_second"]
+        await asyncio.sleep(SETTINGS["ttft"])
+        for index in range(output_tokens):
+            if index and index % burst == 0:
+                await asyncio.sleep(interval)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=TOKENS[index % len(TOKENS)]))
+        input_tokens = sum(len(str(message.content)) for message in messages) // 4
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }))
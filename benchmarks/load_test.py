@@ -0,0 +1,292 @@
+"""Offline load test of the chat streaming endpoint with a fake provider, in-memory data and a stubbed Razorpay client.
+
+The API runs in a child process serving create_app() with DATA_BACKEND=memory, every model pointed at
+fake_provider.FakeChatModel and razorpay replaced by StubRazorpayClient, so nothing leaves the machine.
+Concurrent SSE clients post chat turns for --users users and the report has the client-side time to first token
+(p50/p95/p99), frames and requests per second, and the server's CPU time and peak RSS from resource.getrusage
+(for the whole life of the server process, start-up included).
+
+Baselines are saved as JSON under benchmarks/baselines, --compare exits with status 1 when p95 time to first
+token or CPU per request got worse than the baseline by more than --tolerance.
+
+Usage:
+    python benchmarks/load_test.py --requests 2000 --concurrency 200 --ttft 0.3 --tokens-per-second 80 --save-baseline main
+    python benchmarks/load_test.py --requests 2000 --concurrency 200 --ttft 0.3 --tokens-per-second 80 --compare main
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from jose import jwt
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, "..")
+BASELINES = os.path.join(BENCHMARKS, "baselines")
+SECRET_KEY = "benchmark-secret"
+
+
+class _StubResource:
+    """Answers Razorpay order and payment calls with canned data."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.created = 0
+
+    def create(self, data=None, **kwargs):
+        self.created += 1
+        return {"id": f"{self.kind}_benchmark_{self.created}", "status": "created", **(data or {})}
+
+    def fetch(self, resource_id, data=None, **kwargs):
+        return {
+            "id": resource_id,
+            "order_id": resource_id,
+            "status": "paid" if self.kind == "order" else "captured",
+            "amount": 10000,
+            "amount_paid": 10000,
+            "currency": "INR",
+            "description": "benchmark",
+        }
+
+
+class StubRazorpayClient:
+    """Stand-in for razorpay.Client, so payment endpoints never call Razorpay."""
+
+    def __init__(self):
+        self.order = _StubResource("order")
+        self.payment = _StubResource("pay")
+
+
+def serve(args):
+    """Run the API with the fake provider until SIGINT, in this process."""
+    os.environ.update({
+        "DATA_BACKEND": "memory",
+        "SECRET_KEY": SECRET_KEY,
+        "GOOGLE_CLIENT_ID": os.environ.get("GOOGLE_CLIENT_ID", "benchmark"),
+        "GOOGLE_CLIENT_SECRET": os.environ.get("GOOGLE_CLIENT_SECRET", "benchmark"),
+    })
+    os.environ.setdefault("TOKENIZER_PROCESSES", "0")
+    sys.path[:0] = [ROOT, BENCHMARKS]
+
+    import uvicorn
+    import fake_provider
+    import token_counter
+    import app as chat_app
+
+    fake_provider.configure(ttft=args.ttft, tokens_per_second=args.tokens_per_second, output_tokens=args.output_tokens, burst=args.burst)
+    for config in chat_app.model_company_mapping.values():
+        config["model"] = "fake_provider:FakeChatModel"
+    if args.approximate_tokenizer:
+        # no tokenizer downloads, about four characters per token for every provider
+        for company in token_counter.TOKEN_COUNTERS:
+            token_counter.TOKEN_COUNTERS[company] = lambda text, model_name: len(text) // 4 + 1
+
+    init_clients = chat_app.init_clients
+
+    def init_offline_clients():
+        init_clients()
+        chat_app.client = StubRazorpayClient()
+        # every benchmark user can chat for the whole run
+        chat_app.quota.default_generations = 10 ** 9
+
+    chat_app.init_clients = init_offline_clients
+    uvicorn.run(chat_app.create_app(), host="127.0.0.1", port=args.port, log_level="error", limit_concurrency=100000)
+
+
+def free_port():
+    """Return a free TCP port on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, port):
+    """Start the API in a child process and wait until it answers."""
+    command = [
+        sys.executable, os.path.abspath(__file__), "--serve", "--port", str(port),
+        "--ttft", str(args.ttft), "--tokens-per-second", str(args.tokens_per_second),
+        "--output-tokens", str(args.output_tokens), "--burst", str(args.burst),
+    ]
+    if args.approximate_tokenizer:
+        command.append("--approximate-tokenizer")
+    server = subprocess.Popen(command, cwd=ROOT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The API exited with status {server.returncode} while starting")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The API did not start within 60 seconds")
+
+
+def stop_server(server):
+    """Stop the API gracefully and return its (cpu seconds, peak RSS in MB)."""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    # ru_maxrss is in kilobytes on Linux, the largest child waited for so far
+    return cpu_seconds, after.ru_maxrss / 1024
+
+
+def make_tokens(users):
+    """Create one token per benchmark user, like /auth/google does."""
+    expiry = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    return [jwt.encode({"sub": f"benchmark-user-{user}", "exp": expiry}, SECRET_KEY, algorithm="HS256") for user in range(users)]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run_clients(port, args):
+    """Post args.requests chat turns from args.concurrency concurrent SSE clients."""
+    url = f"http://127.0.0.1:{port}/v1/chat_event_streaming"
+    tokens = make_tokens(args.users)
+    ttfts = []
+    durations = []
+    frames = 0
+    statuses = {}
+    next_request = 0
+
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=None)) as client:
+        async def one_request(index):
+            nonlocal frames
+            body = {"user_input": f"Benchmark question {index}", "chat_history": [], "chat_model": args.model, "temperature": 0.8}
+            headers = {"Authorization": f"Bearer {tokens[index % len(tokens)]}", "Accept": "text/event-stream"}
+            started = time.perf_counter()
+            first_token = None
+            async with client.stream("POST", url, json=body, headers=headers) as response:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    frames += 1
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+            if response.status_code == 200 and first_token is not None:
+                ttfts.append(first_token)
+                durations.append(time.perf_counter() - started)
+
+        async def worker():
+            nonlocal next_request
+            while next_request < args.requests:
+                index = next_request
+                next_request += 1
+                await one_request(index)
+
+        client_cpu = time.process_time()
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        client_cpu = time.process_time() - client_cpu
+
+    ttfts.sort()
+    durations.sort()
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "requests_per_s": round(len(ttfts) / elapsed, 1),
+        "frames_per_s": round(frames / elapsed, 1),
+        "ttft_p50_ms": round(percentile(ttfts, 0.50) * 1000, 1) if ttfts else None,
+        "ttft_p95_ms": round(percentile(ttfts, 0.95) * 1000, 1) if ttfts else None,
+        "ttft_p99_ms": round(percentile(ttfts, 0.99) * 1000, 1) if ttfts else None,
+        "stream_p50_ms": round(percentile(durations, 0.50) * 1000, 1) if durations else None,
+        "stream_p99_ms": round(percentile(durations, 0.99) * 1000, 1) if durations else None,
+        "client_cpu_s": round(client_cpu, 2),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Print the change of each metric against the baseline and return the regressions beyond tolerance."""
+    regressions = []
+    # lower is better for every checked metric
+    for metric in ("ttft_p95_ms", "server_cpu_ms_per_request"):
+        old, new = baseline.get(metric), result.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        print(f"{metric}: {old} -> {new} ({change:+.1%})")
+        if change > tolerance:
+            regressions.append(metric)
+    for metric in ("ttft_p50_ms", "ttft_p99_ms", "frames_per_s", "requests_per_s", "server_max_rss_mb"):
+        old, new = baseline.get(metric), result.get(metric)
+        if old and new is not None:
+            print(f"{metric}: {old} -> {new} ({(new - old) / old:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--model", default="gpt-4o-mini", help="a model of model_company_mapping, its provider budgets apply")
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the fake model's first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--burst", type=int, default=1, help="tokens the fake model sends back to back")
+    parser.add_argument("--approximate-tokenizer", action="store_true", help="count four characters per token instead of loading tokenizers")
+    parser.add_argument("--save-baseline", metavar="NAME", help="save the results as benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="compare with benchmarks/baselines/NAME.json")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed regression against the baseline, 0.10 is 10%%")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    port = free_port()
+    server = start_server(args, port)
+    try:
+        result = asyncio.run(run_clients(port, args))
+    finally:
+        server_cpu, server_rss = stop_server(server)
+    completed = sum(count for code, count in result["statuses"].items() if code == "200")
+    result.update({
+        "server_cpu_s": round(server_cpu, 2),
+        "server_cpu_ms_per_request": round(server_cpu / completed * 1000, 2) if completed else None,
+        "server_max_rss_mb": round(server_rss, 1),
+    })
+    config = {key: getattr(args, key) for key in ("requests", "concurrency", "users", "model", "ttft", "tokens_per_second", "output_tokens", "burst", "approximate_tokenizer")}
+    print(json.dumps({"config": config, **result}, indent=2))
+
+    if args.save_baseline:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, f"{args.save_baseline}.json"), "w") as f:
+            json.dump({"config": config, **result}, f, indent=2)
+    if args.compare:
+        with open(os.path.join(BASELINES, f"{args.compare}.json")) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print(f"warning: the baseline was run with {baseline.get('config')}")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
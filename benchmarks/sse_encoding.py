@@ -0,0 +1,131 @@
+"""Benchmark SSE frame encoding and token coalescing for the chat streaming endpoint.
+
+Encoding: frames/sec and CPU per stream of the old pydantic + jsonable_encoder + json.dumps frames
+against the precompiled sse.encode_token frames.
+Coalescing: frames, CPU and the extra delay of the first and the slowest token for a fast model
+streaming in bursts, with and without sse.coalesce. Frames are written to a local socket like a response body.
+
+Usage:
+    python benchmarks/sse_encoding.py --tokens 2000 --streams 50 --burst 4 --burst-delay 0.004
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+from typing import Optional
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sse  # noqa: E402
+
+
+class ChatEventStreaming(BaseModel):
+    """Same fields as the ChatEventStreaming model in app.py."""
+    event: str
+    data: str
+    is_final: bool
+    chat_id: Optional[str] = None
+
+
+TOKENS = ["Hello", ",", " this", " is", " a", " \"quoted\"", " token", " stream", "\n", " é", "😀", " with", " code", " `x`", "."]
+
+
+def pydantic_frame(token):
+    response = ChatEventStreaming(event="stream", data=token, is_final=False)
+    return f"data: {json.dumps(jsonable_encoder(response))}\n\n"
+
+
+def bench_encoding(encode, tokens, streams):
+    """Return frames/sec and CPU milliseconds per stream of an encoder."""
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for _ in range(streams):
+        for index in range(tokens):
+            encode(TOKENS[index % len(TOKENS)])
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    return {
+        "frames_per_s": round(tokens * streams / elapsed),
+        "cpu_ms_per_stream": round(cpu / streams * 1000, 3),
+    }
+
+
+async def provider(tokens, burst, burst_delay, arrivals):
+    """Fake provider stream delivering tokens in bursts, as network reads carry several events."""
+    loop = asyncio.get_running_loop()
+    for index in range(tokens):
+        if index % burst == 0:
+            await asyncio.sleep(burst_delay)
+        arrivals.append(loop.time())
+        yield TOKENS[index % len(TOKENS)]
+
+
+async def stream(tokens, burst, burst_delay, interval, max_chars):
+    """Run one stream through coalesce and encode_token into a socket, returning (frames, first delay, max delay)."""
+    loop = asyncio.get_running_loop()
+    server_socket, client_socket = socket.socketpair()
+    _, writer = await asyncio.open_connection(sock=server_socket)
+    reader, client_writer = await asyncio.open_connection(sock=client_socket)
+    drain = asyncio.create_task(reader.read())
+    arrivals = []
+    frames = 0
+    sent = 0
+    first_delay = None
+    max_delay = 0.0
+    async for chunk in sse.coalesce(provider(tokens, burst, burst_delay, arrivals), interval, max_chars):
+        writer.write(sse.encode_token(chunk))
+        await writer.drain()
+        frames += 1
+        now = loop.time()
+        # every token up to the ones sent so far waited from its arrival until now
+        oldest = arrivals[sent]
+        sent = len(arrivals)
+        max_delay = max(max_delay, now - oldest)
+        if first_delay is None:
+            first_delay = now - oldest
+    writer.close()
+    await drain
+    client_writer.close()
+    return frames, first_delay, max_delay
+
+
+async def bench_coalescing(tokens, streams, burst, burst_delay, interval, max_chars):
+    cpu_started = time.process_time()
+    results = await asyncio.gather(*(stream(tokens, burst, burst_delay, interval, max_chars) for _ in range(streams)))
+    cpu = time.process_time() - cpu_started
+    return {
+        "interval_ms": interval * 1000,
+        "max_chars": max_chars,
+        "frames_per_stream": round(sum(frames for frames, _, _ in results) / streams, 1),
+        "cpu_ms_per_stream": round(cpu / streams * 1000, 3),
+        "first_token_delay_ms": round(max(first for _, first, _ in results) * 1000, 2),
+        "max_token_delay_ms": round(max(delay for _, _, delay in results) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--burst", type=int, default=4)
+    parser.add_argument("--burst-delay", type=float, default=0.004)
+    parser.add_argument("--interval-ms", type=float, default=15)
+    parser.add_argument("--max-chars", type=int, default=512)
+    args = parser.parse_args()
+
+    print(json.dumps({"encoder": "pydantic_json", **bench_encoding(pydantic_frame, args.tokens, args.streams)}))
+    print(json.dumps({"encoder": "sse_template", "orjson": sse.orjson is not None, **bench_encoding(sse.encode_token, args.tokens, args.streams)}))
+
+    for interval in (0, args.interval_ms / 1000):
+        result = asyncio.run(bench_coalescing(args.tokens, args.streams, args.burst, args.burst_delay, interval, args.max_chars))
+        print(json.dumps({"coalescing": interval > 0, **result}))
+
+
+if __name__ == "__main__":
+    main()
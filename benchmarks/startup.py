@@ -0,0 +1,122 @@
+"""Benchmark the cold start of the API: time to import app.py, peak RSS and which provider SDKs got loaded.
+
+Each run imports app in a fresh interpreter with DATA_BACKEND=memory, once per ENABLED_PROVIDERS value,
+so the cost of the providers that are not enabled shows up as the difference to "all".
+With --lifespan the startup hook (clients, tokenizers, token counting workers) is run as well.
+
+Usage:
+    python benchmarks/startup.py --runs 5 --providers all OpenAI OpenAI,Anthropic --top 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROVIDER_MODULES = [
+    "langchain_openai", "langchain_anthropic", "langchain_mistralai", "langchain_google_genai",
+    "langchain_community", "langchain_together", "anthropic", "openai", "vertexai", "tiktoken",
+    "razorpay", "firebase_admin", "google.cloud.firestore",
+]
+
+CHILD = """
+import asyncio, json, resource, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+started = None
+if {lifespan}:
+    async def run():
+        async with app.lifespan(app.app):
+            pass
+    start = time.perf_counter()
+    asyncio.run(run())
+    started = time.perf_counter() - start
+print(json.dumps({{
+    "import_s": imported,
+    "lifespan_s": started,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+    "loaded": [name for name in {modules!r} if name in sys.modules],
+}}))
+"""
+
+
+def run_once(providers, lifespan, importtime):
+    env = dict(os.environ)
+    env.update({
+        "DATA_BACKEND": "memory",
+        "SECRET_KEY": env.get("SECRET_KEY", "benchmark"),
+        "GOOGLE_CLIENT_ID": env.get("GOOGLE_CLIENT_ID", "benchmark"),
+        "GOOGLE_CLIENT_SECRET": env.get("GOOGLE_CLIENT_SECRET", "benchmark"),
+    })
+    env.pop("ENABLED_PROVIDERS", None)
+    if providers != "all":
+        env["ENABLED_PROVIDERS"] = providers
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", CHILD.format(lifespan=lifespan, modules=PROVIDER_MODULES)]
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing app failed with ENABLED_PROVIDERS={providers}:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(stderr, top):
+    """Return the top-level imports with the largest cumulative time from -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # top-level packages are not indented
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--providers", nargs="+", default=["all", "OpenAI", "OpenAI,Anthropic"],
+                        help='ENABLED_PROVIDERS values to compare, "all" leaves it unset')
+    parser.add_argument("--lifespan", action="store_true", help="also run the startup and shutdown hooks")
+    parser.add_argument("--top", type=int, default=0, help="print the N slowest top-level imports of each configuration")
+    parser.add_argument("--json", help="write the results to this file, e.g. to keep a baseline")
+    args = parser.parse_args()
+
+    results = {}
+    for providers in args.providers:
+        runs = [run_once(providers, args.lifespan, False)[0] for _ in range(args.runs)]
+        import_s = [run["import_s"] for run in runs]
+        results[providers] = {
+            "import_s_median": statistics.median(import_s),
+            "import_s_min": min(import_s),
+            "lifespan_s_median": statistics.median(run["lifespan_s"] for run in runs) if args.lifespan else None,
+            "max_rss_mb": statistics.median(run["max_rss_mb"] for run in runs),
+            "modules": runs[-1]["modules"],
+            "loaded": runs[-1]["loaded"],
+        }
+        result = results[providers]
+        print(f"ENABLED_PROVIDERS={providers}")
+        print(f"  import      median {result['import_s_median'] * 1000:8.1f} ms   min {result['import_s_min'] * 1000:8.1f} ms")
+        if args.lifespan:
+            print(f"  lifespan    median {result['lifespan_s_median'] * 1000:8.1f} ms")
+        print(f"  max RSS     {result['max_rss_mb']:8.1f} MB   modules {result['modules']}")
+        print(f"  SDKs loaded {', '.join(result['loaded']) or '-'}")
+        if args.top:
+            _, stderr = run_once(providers, False, True)
+            for cumulative_ms, name in slowest_imports(stderr, args.top):
+                print(f"    {cumulative_ms:8.1f} ms  {name}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
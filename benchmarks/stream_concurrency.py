@@ -0,0 +1,123 @@
+"""Benchmark concurrent SSE stream capacity for sync vs async streaming generators.
+
+The sync variant mirrors the old `event_streaming()` generator around `conversation.stream(...)`:
+every token wait blocks a threadpool thread. The async variant mirrors the `astream` pipeline.
+
+Usage:
+    python benchmarks/stream_concurrency.py --streams 200 --tokens 50 --token-delay 0.02
+"""
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+
+def build_app(tokens, token_delay):
+    """Build an app exposing a sync and an async fake streaming endpoint."""
+    app = FastAPI()
+
+    def frame(token, is_final=False):
+        return f"data: {json.dumps({'event': 'stream', 'data': token, 'is_final': is_final})}\n\n"
+
+    @app.get("/sync")
+    async def sync_stream():
+        def event_streaming():
+            for _ in range(tokens):
+                # Blocking provider SDK iteration, as with conversation.stream(...)
+                time.sleep(token_delay)
+                yield frame("tok ")
+            yield frame("", is_final=True)
+
+        return StreamingResponse(event_streaming(), media_type="text/event-stream")
+
+    @app.get("/async")
+    async def async_stream():
+        async def event_streaming():
+            for _ in range(tokens):
+                # Non-blocking provider iteration, as with conversation.astream(...)
+                await asyncio.sleep(token_delay)
+                yield frame("tok ")
+            yield frame("", is_final=True)
+
+        return StreamingResponse(event_streaming(), media_type="text/event-stream")
+
+    return app
+
+
+def free_port():
+    """Return a free TCP port on localhost."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app, port):
+    """Run uvicorn in a background thread and wait until it accepts connections."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="error", limit_concurrency=100000))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def run_clients(url, streams):
+    """Open `streams` concurrent SSE clients and measure how many are in flight at once."""
+    in_flight = 0
+    peak_in_flight = 0
+    first_token_latencies = []
+
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=None)) as client:
+        async def one_stream():
+            nonlocal in_flight, peak_in_flight
+            started = time.perf_counter()
+            first_token = None
+            async with client.stream("GET", url) as response:
+                async for chunk in response.aiter_text():
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                        in_flight += 1
+                        peak_in_flight = max(peak_in_flight, in_flight)
+            in_flight -= 1
+            first_token_latencies.append(first_token)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one_stream() for _ in range(streams)))
+        elapsed = time.perf_counter() - started
+
+    first_token_latencies.sort()
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "peak_concurrent_streams": peak_in_flight,
+        "ttft_p50_ms": round(first_token_latencies[len(first_token_latencies) // 2] * 1000, 1),
+        "ttft_max_ms": round(first_token_latencies[-1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    port = free_port()
+    server, thread = start_server(build_app(args.tokens, args.token_delay), port)
+    try:
+        for variant in ("sync", "async"):
+            result = asyncio.run(run_clients(f"http://127.0.0.1:{port}/{variant}", args.streams))
+            print(json.dumps({"variant": variant, "streams": args.streams, **result}))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
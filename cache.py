@@ -0,0 +1,96 @@
+"""In-process caches shared by the server components."""
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire ttl seconds after being set.
+    Not thread-safe, it is only used from the event loop.
+    """
+
+    def __init__(self, max_size=10000, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value, or default if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            del self._entries[key]
+        self.misses += 1
+        return default
+
+    def peek(self, key, default=None):
+        """Return a live cached value without touching the LRU order or the counters."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return default
+
+    def set(self, key, value, ttl=None):
+        """Cache a value for ttl seconds, evicting the least recently used entries beyond max_size."""
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def replace(self, key, value):
+        """Replace the value of a live entry without extending its expiry."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries[key] = (value, entry[1])
+
+    def pop(self, key, default=None):
+        """Remove an entry and return its value."""
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        """Remove every entry."""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return size and hit/miss counters."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class VerifiedTokenCache(TTLCache):
+    """
+    TTLCache of verified token claims keyed by the SHA-256 digest of the token.
+    An entry never outlives the token's own exp claim, so expired tokens always go through verification again.
+    """
+
+    def get_claims(self, token, verify):
+        """Return the claims of a token, calling verify(token) only on a cache miss."""
+        key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        claims = self.get(key)
+        if claims is None:
+            claims = verify(token)
+            ttl = self.ttl
+            if 'exp' in claims:
+                ttl = min(ttl, claims['exp'] - time.time())
+            if ttl > 0:
+                self.set(key, claims, ttl=ttl)
+        return dict(claims)
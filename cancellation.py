@@ -0,0 +1,64 @@
+"""Detect clients that leave mid-stream and account for the generation cancelled upstream."""
+import asyncio
+import logging
+
+
+class DisconnectMonitor:
+    """
+    Polls request.is_disconnected() while a stream is open, so the upstream LLM call can be cancelled right away.
+    Tokens saved are estimated per model from the average output of streams that ran to completion.
+    """
+
+    def __init__(self, poll_interval=0.25, smoothing=0.1):
+        self.poll_interval = poll_interval
+        self.smoothing = smoothing
+        self.average_output_tokens = {}
+        self.completed_streams = 0
+        self.cancelled_streams = 0
+        self.tokens_saved = 0
+        self._tasks = set()
+
+    async def watch(self, request, stop):
+        """Set the result of the stop future once the client has disconnected."""
+        try:
+            while not stop.done():
+                if await request.is_disconnected():
+                    if not stop.done():
+                        stop.set_result(None)
+                    return
+                await asyncio.sleep(self.poll_interval)
+        except Exception as e:
+            logging.error(f'Error watching for client disconnect: {e}')
+
+    def start(self, request, stop):
+        """Watch a request in the background until stop is done."""
+        self.spawn(self.watch(request, stop))
+
+    def spawn(self, coroutine):
+        """Run a coroutine in a task of its own, e.g. to save a turn after the stream's task was cancelled."""
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def record(self, model_name, output_tokens, cancelled):
+        """Record a finished stream, cancelled streams count the tokens the model was expected to still generate."""
+        average = self.average_output_tokens.get(model_name)
+        if cancelled:
+            self.cancelled_streams += 1
+            if average is not None:
+                self.tokens_saved += max(int(average) - output_tokens, 0)
+            return
+        self.completed_streams += 1
+        if average is None:
+            self.average_output_tokens[model_name] = float(output_tokens)
+        else:
+            self.average_output_tokens[model_name] = average + self.smoothing * (output_tokens - average)
+
+    def stats(self):
+        """Return the disconnect counters."""
+        return {
+            "completed_streams": self.completed_streams,
+            "cancelled_streams": self.cancelled_streams,
+            "tokens_saved": self.tokens_saved,
+        }
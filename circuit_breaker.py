@@ -0,0 +1,120 @@
+"""Per-provider circuit breakers fed by the outcome of real chat calls."""
+import time
+from collections import deque
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Opens when at least failure_rate of the last window calls failed, counting calls slower than
+    slow_call_seconds to the first token as failures. While open, calls fail fast. After open_seconds
+    it turns half-open and lets max_probes calls through, the first probe outcome closes or reopens it.
+    """
+
+    def __init__(self, window=20, min_calls=5, failure_rate=0.5, slow_call_seconds=20.0, open_seconds=30.0, max_probes=1):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.max_probes = max_probes
+        self.state = CLOSED
+        # True for each failed call among the last window calls
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.latency = None
+        self.rejected = 0
+
+    def allow(self):
+        """Return whether a call may go to the provider, half-open breakers count it as a probe."""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self.probes = 0
+        if self.state == HALF_OPEN:
+            if self.probes >= self.max_probes:
+                self.rejected += 1
+                return False
+            self.probes += 1
+        return True
+
+    def is_available(self):
+        """Return whether a call would be let through right now, without counting it."""
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.open_seconds
+        if self.state == HALF_OPEN:
+            return self.probes < self.max_probes
+        return True
+
+    def record_success(self, first_token_seconds):
+        """Record a call that produced its first token after first_token_seconds."""
+        # exponentially weighted time to first token, for the health endpoint
+        self.latency = first_token_seconds if self.latency is None else self.latency + 0.2 * (first_token_seconds - self.latency)
+        if first_token_seconds >= self.slow_call_seconds:
+            self.record_failure()
+            return
+        if self.state == HALF_OPEN:
+            self._close()
+            return
+        self.outcomes.append(False)
+
+    def record_failure(self):
+        """Record a call that failed before or while streaming."""
+        if self.state == HALF_OPEN:
+            self._open()
+            return
+        self.outcomes.append(True)
+        if self.state == CLOSED and len(self.outcomes) >= self.min_calls and sum(self.outcomes) / len(self.outcomes) >= self.failure_rate:
+            self._open()
+
+    def record_cancelled(self):
+        """Record a call cancelled before an outcome, e.g. by a client disconnect, freeing its probe."""
+        if self.state == HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def _close(self):
+        self.state = CLOSED
+        self.outcomes.clear()
+
+    def health(self):
+        """Return the state, recent error rate and smoothed time to first token."""
+        return {
+            "state": self.state,
+            "available": self.is_available(),
+            "error_rate": sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0,
+            "calls": len(self.outcomes),
+            "time_to_first_token_s": self.latency,
+            "rejected": self.rejected,
+        }
+
+
+class CircuitBreakers:
+    """One CircuitBreaker per provider, created on first use."""
+
+    def __init__(self, **options):
+        self.options = options
+        self.breakers = {}
+
+    def get(self, company):
+        breaker = self.breakers.get(company)
+        if breaker is None:
+            breaker = self.breakers[company] = CircuitBreaker(**self.options)
+        return breaker
+
+    def stats(self):
+        """Return the health of every provider seen so far."""
+        return {company: breaker.health() for company, breaker in self.breakers.items()}
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because its provider's breaker is open."""
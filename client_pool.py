@@ -0,0 +1,126 @@
+"""Pool of reusable provider chat clients shared across requests."""
+import importlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import httpx
+
+
+# Chat classes built on the OpenAI SDK accept injected httpx clients, so every model of the
+# same provider can share one keep-alive connection pool.
+SHARED_HTTP_CLIENT_CLASSES = {"ChatOpenAI", "ChatTogether"}
+
+
+@lru_cache(maxsize=None)
+def load_class(path):
+    """Import a "module:Class" path, so a provider SDK is only loaded once one of its models is used."""
+    module_name, class_name = path.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class ChatClientPool:
+    """
+    Bounded LRU pool of chat model instances keyed by (provider class, model, temperature, params).
+    Provider classes are given as "module:Class" paths and imported on first use.
+    Idle entries are evicted after `idle_ttl` seconds.
+    """
+
+    def __init__(self, max_size=64, idle_ttl=600.0, max_keepalive_connections=20, keepalive_expiry=120.0):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._limits = httpx.Limits(
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._clients = OrderedDict()
+        self._http_clients = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model_class, model_name, temperature, **params):
+        """Return a pooled chat client, creating it on a miss."""
+        key = (model_class, model_name, temperature, tuple(sorted(params.items())))
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry is not None:
+                self._clients.move_to_end(key)
+                entry[1] = now
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        chat = self._create(model_class, model_name, temperature, params)
+
+        with self._lock:
+            # Another request may have created the same client in the meantime, keep the first one
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry[1] = now
+                return entry[0]
+            self._clients[key] = [chat, now]
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+        return chat
+
+    def _create(self, model_class, model_name, temperature, params):
+        """Instantiate a chat client, wiring in the shared HTTP pools when the class supports it."""
+        kwargs = dict(model_name=model_name, model=model_name, temperature=temperature, **params)
+        class_name = model_class.split(":")[1]
+        if class_name in SHARED_HTTP_CLIENT_CLASSES:
+            http_client, http_async_client = self._get_http_clients(class_name)
+            kwargs["http_client"] = http_client
+            kwargs["http_async_client"] = http_async_client
+        return load_class(model_class)(**kwargs)
+
+    def _get_http_clients(self, provider):
+        """Return the (sync, async) httpx clients shared by every model of a provider."""
+        with self._lock:
+            clients = self._http_clients.get(provider)
+            if clients is None:
+                clients = (httpx.Client(limits=self._limits), httpx.AsyncClient(limits=self._limits))
+                self._http_clients[provider] = clients
+            return clients
+
+    def _evict_idle(self, now):
+        """Drop clients that have not been used within idle_ttl. Caller must hold the lock."""
+        while self._clients:
+            key, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._clients[key]
+            self.evictions += 1
+
+    def stats(self):
+        """Return pool hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._clients),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "http_pools": sorted(self._http_clients),
+            }
+
+    async def aclose(self):
+        """Close the shared HTTP connection pools."""
+        with self._lock:
+            http_clients = list(self._http_clients.values())
+            self._http_clients.clear()
+            self._clients.clear()
+        for http_client, http_async_client in http_clients:
+            try:
+                http_client.close()
+                await http_async_client.aclose()
+            except Exception as e:
+                logging.error(f'Error closing HTTP client: {e}')
@@ -0,0 +1,189 @@
+"""Token-budgeted context window management per model."""
+import asyncio
+import hashlib
+import logging
+import math
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+import token_counter
+from cache import TTLCache
+from repository import Write
+
+
+# Default model used to fold the turns that no longer fit into the rolling summary
+SUMMARY_MODEL = "gpt-4o-mini"
+
+# Tokens kept free for the answer, at most a quarter of the context window
+OUTPUT_TOKEN_RESERVE = 1024
+
+# Upper bound on the history sent to any model, so long chats do not get slower and costlier without end
+MAX_HISTORY_TOKENS = 16000
+
+# Tokens set aside for the rolling summary when older turns are folded into it
+SUMMARY_TOKEN_RESERVE = 512
+
+# Approximate per-message overhead of the chat formats (role markers, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Longest message text passed to the summary model
+SUMMARY_MESSAGE_CHARS = 4000
+
+
+def turn_fingerprint(user_message, ai_message):
+    """Identify a turn by its content, so a summary can say up to which turn it covers."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(user_message.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(ai_message.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ContextBuilder:
+    """
+    Picks the newest turns that fit the model's token budget. Older turns are folded in the background into a
+    rolling summary stored on the chat document, and the stored summary stands in for them in the context.
+    """
+
+    def __init__(self, repository, write_behind_queue, background_caller, model_company_mapping, summary_model=SUMMARY_MODEL):
+        self.repository = repository
+        self.write_behind_queue = write_behind_queue
+        self.background_caller = background_caller
+        self.model_company_mapping = model_company_mapping
+        self.summary_model = summary_model
+        # Token count per (model, message digest), so the budget never re-tokenizes a message it has seen
+        self.token_counts = TTLCache(max_size=50000, ttl=3600)
+        # (summary, summary_until) per chat_id, summary_until is the fingerprint of the last folded turn
+        self.summaries = TTLCache(max_size=5000, ttl=3600)
+        self._summarizing = set()
+        self.summaries_generated = 0
+
+    async def count_tokens(self, texts, model_name):
+        """
+        Count the tokens of messages for a model, cached by message digest. The uncached ones are counted together,
+        off the event loop when they are large.
+        """
+        keys = [(model_name, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()) for text in texts]
+        token_lengths = [self.token_counts.get(key) for key in keys]
+        missing = [index for index, token_length in enumerate(token_lengths) if token_length is None]
+        if missing:
+            company = self.model_company_mapping[model_name]['company']
+            counts = await token_counter.acount_tokens_batch([texts[index] for index in missing], model_name, company)
+            for index, count in zip(missing, counts):
+                token_lengths[index] = count + MESSAGE_TOKEN_OVERHEAD
+                self.token_counts.set(keys[index], token_lengths[index])
+        return token_lengths
+
+    async def history_budget(self, model_name, user_input):
+        """Return the number of tokens the history may use for a request."""
+        context_window = self.model_company_mapping[model_name]['context_window']
+        output_reserve = min(OUTPUT_TOKEN_RESERVE, context_window // 4)
+        [input_tokens] = await self.count_tokens([user_input], model_name)
+        return min(context_window - output_reserve - input_tokens, MAX_HISTORY_TOKENS)
+
+    @staticmethod
+    def _fit(turn_tokens, budget):
+        """Return the index of the oldest turn kept so that the turns from index on fit in budget."""
+        used = 0
+        index = len(turn_tokens)
+        while index > 0:
+            cost = turn_tokens[index - 1]
+            if used + cost > budget:
+                break
+            used += cost
+            index -= 1
+        return index
+
+    async def build(self, chat_id, turns, user_input, model_name):
+        """Return the history messages to send with user_input, newest turns first to be kept."""
+        budget = await self.history_budget(model_name, user_input)
+        # Only the newest turns that could fit are counted, every turn costs at least the overhead of its two messages
+        newest = turns[max(len(turns) - budget // (2 * MESSAGE_TOKEN_OVERHEAD), 0):] if budget > 0 else []
+        token_lengths = await self.count_tokens([text for turn in newest for text in turn], model_name)
+        turn_tokens = [math.inf] * (len(turns) - len(newest)) + [
+            token_lengths[index] + token_lengths[index + 1] for index in range(0, len(token_lengths), 2)
+        ]
+        start = self._fit(turn_tokens, budget)
+        if start == 0:
+            return self._messages(turns, None)
+
+        # Older turns do not fit, leave room for the summary that stands in for them
+        start = max(start, self._fit(turn_tokens, budget - SUMMARY_TOKEN_RESERVE))
+        folded = turns[:start]
+        summary, summary_until = await self._get_summary(chat_id)
+
+        fingerprints = [turn_fingerprint(user_message, ai_message) for user_message, ai_message in folded]
+        if summary_until in fingerprints:
+            # The summary covers a prefix of the folded turns, fold the rest in the background
+            to_fold = folded[fingerprints.index(summary_until) + 1:]
+        elif summary_until is not None and any(turn_fingerprint(*turn) == summary_until for turn in turns[start:]):
+            # The summary reaches into the turns that are sent in full, it would only repeat them
+            summary = None
+            to_fold = []
+        else:
+            # No summary yet, or it covers turns older than the ones the client sent
+            to_fold = folded
+
+        if chat_id and to_fold:
+            self._schedule_summary(chat_id, summary, to_fold, fingerprints[-1])
+        return self._messages(turns[start:], summary)
+
+    @staticmethod
+    def _messages(turns, summary):
+        messages = []
+        if summary:
+            # A plain user/assistant pair works with every provider, unlike a system message mid-conversation
+            messages.append(HumanMessage(content="Summarize our earlier conversation."))
+            messages.append(AIMessage(content=summary))
+        for user_message, ai_message in turns:
+            messages.append(HumanMessage(content=user_message))
+            messages.append(AIMessage(content=ai_message))
+        return messages
+
+    async def _get_summary(self, chat_id):
+        """Return the (summary, summary_until) stored with the chat."""
+        if not chat_id:
+            return None, None
+        cached = self.summaries.get(chat_id)
+        if cached is None:
+            chat_data = self.write_behind_queue.pending('chats', chat_id) or await self.repository.get_chat(chat_id) or {}
+            cached = (chat_data.get('summary'), chat_data.get('summary_until'))
+            self.summaries.set(chat_id, cached)
+        return cached
+
+    def _schedule_summary(self, chat_id, summary, turns, summary_until):
+        """Fold turns into the chat summary in the background, once per chat at a time."""
+        if chat_id in self._summarizing:
+            return
+        self._summarizing.add(chat_id)
+        task = asyncio.create_task(self._summarize(chat_id, summary, turns, summary_until))
+        task.add_done_callback(lambda _: self._summarizing.discard(chat_id))
+
+    async def _summarize(self, chat_id, summary, turns, summary_until):
+        try:
+            transcript = "\n\n".join(
+                f"User: {user_message[:SUMMARY_MESSAGE_CHARS]}\nAssistant: {ai_message[:SUMMARY_MESSAGE_CHARS]}"
+                for user_message, ai_message in turns
+            )
+            response = await self.background_caller.invoke(self.summary_model, "summary", [
+                SystemMessage(content="You maintain a running summary of a conversation between a user and an assistant. Keep every fact, decision and open question needed to continue the conversation. Answer with the updated summary only, in under 250 words."),
+                HumanMessage(content=f"Current summary:\n{summary or '(none)'}\n\nNew turns to fold in:\n{transcript}"),
+            ])
+            new_summary = response.content.strip()
+            self.summaries.set(chat_id, (new_summary, summary_until))
+            self.write_behind_queue.enqueue([Write('update', 'chats', chat_id, {
+                'summary': new_summary,
+                'summary_until': summary_until,
+            })])
+            self.summaries_generated += 1
+        except Exception as e:
+            logging.error(f'Error summarizing chat {chat_id}: {e}')
+
+    def stats(self):
+        """Return the token count and summary cache counters."""
+        return {
+            "token_counts": self.token_counts.stats(),
+            "summaries": self.summaries.stats(),
+            "summaries_generated": self.summaries_generated,
+            "summaries_in_progress": len(self._summarizing),
+        }
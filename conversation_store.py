@@ -0,0 +1,81 @@
+"""Server-side conversation state so clients only send the new turn."""
+from collections import namedtuple
+
+from cache import TTLCache
+
+
+# A user message and the AI answer to it
+Turn = namedtuple('Turn', ['user_message', 'ai_message'])
+
+
+def apply_turn(turns, turn, regenerate_message):
+    """Append a turn, a regenerated turn replaces the one before it like in the chat view."""
+    if regenerate_message and turns:
+        turns.pop()
+    turns.append(turn)
+
+
+class ConversationStore:
+    """
+    Bounded LRU of the turns of recently active conversations.
+    A miss rebuilds the conversation from the repository, new turns are appended incrementally.
+    Each entry keeps the turn_count of the chat it was built from, a chat the database has more turns of
+    (added by another worker) is rebuilt.
+    """
+
+    def __init__(self, repository, write_behind_queue, max_conversations=2000, max_turns=100, ttl=3600.0, page_size=50):
+        self.repository = repository
+        self.write_behind_queue = write_behind_queue
+        self.max_turns = max_turns
+        self.page_size = page_size
+        self.cache = TTLCache(max_size=max_conversations, ttl=ttl)
+
+    async def get_turns(self, chat_id, turn_count=None):
+        """
+        Return a copy of the turns of a chat, oldest first.
+        turn_count is the chat's turn_count in the database, a cached entry built from another count is reloaded.
+        """
+        entry = self.cache.get(chat_id)
+        # Turns of this worker still in the write-behind queue are in the cache but not counted in the database yet
+        if entry is not None and entry[1] != turn_count and not self.write_behind_queue.is_pending('chats', chat_id):
+            entry = None
+        if entry is None:
+            entry = (await self._load(chat_id), turn_count)
+            self.cache.set(chat_id, entry)
+        return list(entry[0])
+
+    async def _load(self, chat_id):
+        # Turns still in the write-behind queue are not in the database yet
+        if self.write_behind_queue.is_pending('chats', chat_id):
+            await self.write_behind_queue.wait_flushed()
+
+        turns = []
+        start_after = None
+        while True:
+            page = await self.repository.list_chat_history(chat_id, self.page_size, start_after=start_after)
+            for _, chat_data in page:
+                apply_turn(turns, Turn(chat_data['user_message'], chat_data['ai_message']), chat_data.get('regenerate_message'))
+            if len(page) < self.page_size:
+                break
+            last_document_id, last_chat_data = page[-1]
+            start_after = (last_chat_data['created_at'], last_document_id)
+        return turns[-self.max_turns:]
+
+    def add_turn(self, chat_id, user_message, ai_message, regenerate_message=False, is_new_chat=False):
+        """Append a new turn to a cached conversation, uncached ones are loaded on their next use."""
+        if is_new_chat:
+            self.cache.set(chat_id, ([Turn(user_message, ai_message)], 1))
+            return
+        entry = self.cache.peek(chat_id)
+        if entry is None:
+            return
+        turns, turn_count = entry
+        apply_turn(turns, Turn(user_message, ai_message), regenerate_message)
+        if len(turns) > self.max_turns:
+            del turns[:len(turns) - self.max_turns]
+        # None for chats created before turns were counted, their count starts at 1 like in the database
+        self.cache.replace(chat_id, (turns, (turn_count or 0) + 1))
+
+    def stats(self):
+        """Return the cache counters."""
+        return self.cache.stats()
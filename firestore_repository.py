@@ -0,0 +1,133 @@
+"""Repository backed by the async Firestore client, kept apart so the in-memory backend does not import the Google SDK."""
+from google.cloud import firestore as google_firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import AlreadyExists
+
+from repository import DocumentExists, Repository
+
+
+class FirestoreRepository(Repository):
+    """Repository backed by the async Firestore client."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def get_user(self, google_user_id):
+        user = await self.db.collection('users').document(google_user_id).get()
+        return user.to_dict() if user.exists else None
+
+    async def create_user(self, google_user_id, user_data):
+        await self.db.collection('users').document(google_user_id).set({
+            **user_data,
+            'created_at': google_firestore.SERVER_TIMESTAMP,
+        })
+
+    async def get_chat(self, chat_id):
+        # The document ID is the chat_id, a direct get avoids running a query
+        chat = await self.db.collection('chats').document(chat_id).get()
+        return chat.to_dict() if chat.exists else None
+
+    async def list_chats(self, google_user_id, limit, offset=0, start_after=None):
+        chats_ref = self.db.collection('chats')
+        # The document ID is the chat_id, ordering on it matches the implicit tie-break of the existing index
+        chat_ref = chats_ref.where(filter=FieldFilter('google_user_id', '==', google_user_id)).order_by('updated_at', direction=google_firestore.Query.DESCENDING).order_by(FieldPath.document_id(), direction=google_firestore.Query.DESCENDING)
+        if start_after is not None:
+            updated_at, chat_id = start_after
+            chat_ref = chat_ref.start_after({'updated_at': updated_at, FieldPath.document_id(): chats_ref.document(chat_id)})
+        elif offset:
+            chat_ref = chat_ref.offset(offset)
+        return [chat_data.to_dict() async for chat_data in chat_ref.limit(limit).stream()]
+
+    async def list_chat_history(self, chat_id, limit, start_after=None):
+        chat_history_collection = self.db.collection('chat_history')
+        chat_history_ref = chat_history_collection.where(filter=FieldFilter('chat_id', '==', chat_id)).order_by('created_at').order_by(FieldPath.document_id())
+        if start_after is not None:
+            created_at, document_id = start_after
+            chat_history_ref = chat_history_ref.start_after({'created_at': created_at, FieldPath.document_id(): chat_history_collection.document(document_id)})
+        return [(chat_data.id, chat_data.to_dict()) async for chat_data in chat_history_ref.limit(limit).stream()]
+
+    async def get_user_generations(self, google_user_id):
+        user_generations = await self.db.collection('user_generations').document(google_user_id).get()
+        return user_generations.to_dict() if user_generations.exists else None
+
+    async def create_user_generations(self, google_user_id, remaining_generations):
+        await self.db.collection('user_generations').document(google_user_id).set({
+            'google_user_id': google_user_id,
+            'remaining_generations': remaining_generations,
+            'created_at': google_firestore.SERVER_TIMESTAMP,
+            'updated_at': google_firestore.SERVER_TIMESTAMP,
+        })
+
+    async def reserve_generation(self, google_user_id):
+        user_generations_ref = self.db.collection('user_generations').document(google_user_id)
+
+        @google_firestore.async_transactional
+        async def take_generation(transaction):
+            user_generations = await user_generations_ref.get(transaction=transaction)
+            remaining_generations = user_generations.get('remaining_generations') if user_generations.exists else 0
+            if remaining_generations <= 0:
+                return None
+            transaction.update(user_generations_ref, {
+                'remaining_generations': remaining_generations - 1,
+                'updated_at': google_firestore.SERVER_TIMESTAMP,
+            })
+            return remaining_generations - 1
+
+        return await take_generation(self.db.transaction())
+
+    async def add_order(self, order_data):
+        await self.db.collection('orders').add({
+            **order_data,
+            'created_at': google_firestore.SERVER_TIMESTAMP,
+            'updated_at': google_firestore.SERVER_TIMESTAMP,
+        })
+
+    async def find_payment(self, payment_id, customer_id=None):
+        payment_ref = self.db.collection('payments').where(filter=FieldFilter('payment_id', '==', payment_id))
+        if customer_id is not None:
+            payment_ref = payment_ref.where(filter=FieldFilter('customer_id', '==', customer_id))
+        async for payment_data in payment_ref.limit(1).stream():
+            return payment_data.to_dict()
+        return None
+
+    async def list_payments(self, customer_id):
+        receipt_ref = self.db.collection('payments').where(filter=FieldFilter('customer_id', '==', customer_id)).order_by('updated_at', direction=google_firestore.Query.DESCENDING)
+        return [receipt_data.to_dict() async for receipt_data in receipt_ref.stream()]
+
+    async def has_payment(self, customer_id):
+        payment_ref = self.db.collection('payments').where(filter=FieldFilter('customer_id', '==', customer_id)).limit(1)
+        async for _ in payment_ref.stream():
+            return True
+        return False
+
+    async def commit_writes(self, writes):
+        batch = self.db.batch()
+        for write in writes:
+            document_ref = self.db.collection(write.collection).document(write.document_id)
+            if write.operation == 'set':
+                batch.set(document_ref, {
+                    **write.data,
+                    'created_at': google_firestore.SERVER_TIMESTAMP,
+                    'updated_at': google_firestore.SERVER_TIMESTAMP,
+                })
+            elif write.operation == 'create':
+                batch.create(document_ref, {
+                    **write.data,
+                    'created_at': google_firestore.SERVER_TIMESTAMP,
+                    'updated_at': google_firestore.SERVER_TIMESTAMP,
+                })
+            elif write.operation == 'increment':
+                batch.update(document_ref, {
+                    **{field: google_firestore.Increment(amount) for field, amount in write.data.items()},
+                    'updated_at': google_firestore.SERVER_TIMESTAMP,
+                })
+            else:
+                batch.update(document_ref, {
+                    **write.data,
+                    'updated_at': google_firestore.SERVER_TIMESTAMP,
+                })
+        try:
+            await batch.commit()
+        except AlreadyExists as e:
+            raise DocumentExists(str(e)) from e
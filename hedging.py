@@ -0,0 +1,92 @@
+"""Hedged streaming: race an equivalent model when the first token is late."""
+import asyncio
+
+
+_END = object()
+
+
+class _Runner:
+    """Iterates one stream in a task of its own, so it can be raced and cancelled without changing task."""
+
+    def __init__(self, stream):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._pump(stream))
+
+    async def _pump(self, stream):
+        try:
+            async for item in stream:
+                self.queue.put_nowait(item)
+            self.queue.put_nowait(_END)
+        except Exception as e:
+            self.queue.put_nowait(e)
+
+    async def cancel(self):
+        if not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+class HedgeResult:
+    """Outcome of a hedged stream: whether the hedge was started and which stream answered (0 primary, 1 hedge)."""
+
+    def __init__(self):
+        self.hedged = False
+        self.winner = None
+
+
+async def hedged_stream(primary, start_hedge, deadline, result):
+    """
+    Yield the items of the primary stream, unless it has produced nothing within deadline seconds.
+    Then start_hedge() is called for an equivalent stream (or None to keep waiting) and whichever stream
+    produces first is kept, the other is cancelled. A stream failing before its first item leaves the race.
+    """
+    runners = [_Runner(primary)]
+    getters = {}
+    try:
+        getters[0] = asyncio.ensure_future(runners[0].queue.get())
+        done, _ = await asyncio.wait((getters[0],), timeout=deadline)
+        if not done:
+            hedge = start_hedge()
+            if hedge is not None:
+                result.hedged = True
+                runners.append(_Runner(hedge))
+                getters[1] = asyncio.ensure_future(runners[1].queue.get())
+
+        first = None
+        error = None
+        while getters:
+            done, _ = await asyncio.wait(getters.values(), return_when=asyncio.FIRST_COMPLETED)
+            # the primary wins a tie
+            for index in sorted(getters):
+                if getters[index] in done:
+                    item = getters.pop(index).result()
+                    if isinstance(item, Exception):
+                        error = error or item
+                        continue
+                    result.winner = index
+                    first = item
+                    break
+            if result.winner is not None:
+                break
+        if result.winner is None:
+            raise error
+
+        for index, runner in enumerate(runners):
+            if index != result.winner:
+                await runner.cancel()
+
+        item = first
+        queue = runners[result.winner].queue
+        while item is not _END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            item = await queue.get()
+    finally:
+        for getter in getters.values():
+            getter.cancel()
+        for runner in runners:
+            await runner.cancel()
@@ -0,0 +1,207 @@
+"""Prometheus counters and histograms rendered in the text exposition format, without a client library."""
+import glob
+import json
+import math
+import os
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cache hit to a slow model
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one count per bucket plus +Inf, made cumulative when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        """Return the child for these label values, keep it to skip the lookup on hot paths."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Return [label values, data] of every child, in a JSON-serializable form."""
+        return [[list(values), self._dump(child)] for values, child in list(self._children.items())]
+
+    def _dump(self, child):
+        raise NotImplementedError
+
+    def _merge(self, child, data):
+        raise NotImplementedError
+
+    def render(self, snapshots=None):
+        """Render the children of this process, or the sum of the children in snapshots when given."""
+        children = self._children
+        if snapshots is not None:
+            children = {}
+            for snapshot in snapshots:
+                for values, data in snapshot:
+                    values = tuple(values)
+                    child = children.get(values)
+                    if child is None:
+                        child = children[values] = self._new_child()
+                    self._merge(child, data)
+        family = self.name + "_total" if self.kind == "counter" else self.name
+        lines = [f"# HELP {family} {self.documentation}", f"# TYPE {family} {self.kind}"]
+        for values, child in list(children.items()):
+            self._render_child(lines, values, child)
+        return lines
+
+    def _render_child(self, lines, values, child):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonic count, e.g. requests or tokens, per label values."""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _dump(self, child):
+        return child.value
+
+    def _merge(self, child, data):
+        child.value += data
+
+    def _render_child(self, lines, values, child):
+        lines.append(f"{self.name}_total{_format_labels(self.labelnames, values)} {_format_value(child.value)}")
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets, per label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _dump(self, child):
+        return {"counts": child.counts, "sum": child.sum}
+
+    def _merge(self, child, data):
+        if len(data["counts"]) != len(child.counts):
+            # written by a worker running other buckets, e.g. during a deploy
+            return
+        child.counts = [count + other for count, other in zip(child.counts, data["counts"])]
+        child.sum += data["sum"]
+
+    def _render_child(self, lines, values, child):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), child.counts):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+
+
+class Registry:
+    """
+    The metrics of this process, rendered together on /metrics.
+    Worker processes of one server share a directory: each writes its snapshot there as <pid>.json and
+    render(directory) sums the snapshots of every worker, those of exited workers included so counters never go back.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """Add a metric, replacing the one of the same name, e.g. defined again when app.py runs as __main__ and is imported as app."""
+        for index, registered in enumerate(self.metrics):
+            if registered.name == metric.name:
+                self.metrics[index] = metric
+                return
+        self.metrics.append(metric)
+
+    def write_snapshot(self, directory):
+        """Write the values of this process to directory, replacing its previous snapshot atomically."""
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({metric.name: metric.snapshot() for metric in self.metrics}, f)
+        os.replace(path + ".tmp", path)
+
+    def render(self, directory=None):
+        snapshots = None
+        if directory is not None:
+            self.write_snapshot(directory)
+            snapshots = []
+            for path in glob.glob(os.path.join(directory, "*.json")):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    # removed or half written by a worker that was killed
+                    continue
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(None if snapshots is None else [snapshot.get(metric.name, []) for snapshot in snapshots]))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
@@ -0,0 +1,156 @@
+"""Per-request timing breakdown and an opt-in sampling profiler of the event loop thread."""
+import hmac
+import itertools
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class RequestTimings:
+    """Durations of the phases of one request, in the order they were first recorded."""
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def server_timing(self):
+        """Return the phases as a Server-Timing header value, in milliseconds."""
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items())
+
+    def as_dict(self):
+        """Return the phases in milliseconds."""
+        return {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()}
+
+
+class _Session:
+    __slots__ = ('id', 'label', 'started_at', 'ended_at', 'samples', 'stacks')
+
+    def __init__(self, session_id, label):
+        self.id = session_id
+        self.label = label
+        self.started_at = time.time()
+        self.ended_at = None
+        self.samples = 0
+        # folded stack "module:function;module:function" -> samples
+        self.stacks = {}
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the event loop thread every interval seconds while a profiled request is open.
+    Requests are profiled at sample_percent percent, or when they send the admin token. All requests share the
+    event loop, so a profile shows everything the loop did while the request was open, not only its own work.
+    The last max_profiles profiles are kept as folded stacks, the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, sample_percent=0.0, admin_token=None, interval=0.005, max_profiles=20, max_seconds=300.0, max_depth=64):
+        self.sample_percent = sample_percent
+        self.admin_token = admin_token
+        self.interval = interval
+        self.max_profiles = max_profiles
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.profiles = OrderedDict()
+        self._active = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._target_thread_id = None
+
+    def is_admin(self, token):
+        """Return whether token is the admin token, always False when no admin token is configured."""
+        return bool(self.admin_token and token and hmac.compare_digest(token, self.admin_token))
+
+    def should_profile(self, admin_token=None):
+        """Return whether to profile a request, sent the admin token or picked at sample_percent percent."""
+        return self.is_admin(admin_token) or (self.sample_percent > 0 and random.random() * 100 < self.sample_percent)
+
+    def start(self, label):
+        """Start profiling a request of the calling (event loop) thread, returns the session to stop."""
+        session = _Session(next(self._ids), label)
+        with self._lock:
+            self._target_thread_id = threading.get_ident()
+            self._active.add(session)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+                self._thread.start()
+        return session
+
+    def stop(self, session):
+        """Stop a session and keep its profile, stopping twice is a no-op."""
+        if session is None:
+            return
+        with self._lock:
+            if session not in self._active:
+                return
+            self._active.discard(session)
+            session.ended_at = time.time()
+            self.profiles[session.id] = session
+            while len(self.profiles) > self.max_profiles:
+                self.profiles.popitem(last=False)
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                sessions = list(self._active)
+                thread_id = self._target_thread_id
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stack = self._fold(frame)
+                now = time.time()
+                for session in sessions:
+                    if now - session.started_at > self.max_seconds:
+                        # never stopped, e.g. the request failed before streaming
+                        self.stop(session)
+                        continue
+                    session.samples += 1
+                    session.stacks[stack] = session.stacks.get(stack, 0) + 1
+            time.sleep(self.interval)
+
+    def _fold(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def summaries(self):
+        """Return the kept profiles, most recent first."""
+        with self._lock:
+            profiles = list(self.profiles.values())
+        return [
+            {
+                "id": session.id,
+                "label": session.label,
+                "started_at": session.started_at,
+                "duration_s": session.ended_at - session.started_at,
+                "samples": session.samples,
+            }
+            for session in reversed(profiles)
+        ]
+
+    def folded(self, profile_id):
+        """Return a kept profile as folded stacks, one "stack count" line each, or None."""
+        with self._lock:
+            session = self.profiles.get(profile_id)
+            if session is None:
+                return None
+            stacks = dict(session.stacks)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
@@ -0,0 +1,100 @@
+"""Generation quota accounting with atomic reserve, commit and refund."""
+from cache import TTLCache
+from repository import Write
+
+
+class QuotaManager:
+    """
+    Tracks the remaining generations of each user.
+
+    A generation is reserved before the provider is called and either committed once the turn is saved
+    or refunded if it fails. Every change is a server-side increment or a transaction, so concurrent tabs never lose updates.
+    Reservations are always a transaction on the stored count, so processes sharing the database never hand out
+    the same generation and the quota never goes negative.
+    The remaining count is cached per user for cache_ttl seconds so the read-only pre-flight check skips Firestore.
+    """
+
+    def __init__(self, repository, write_behind_queue, default_generations=20, cache_ttl=5.0):
+        self.repository = repository
+        self.write_behind_queue = write_behind_queue
+        self.default_generations = default_generations
+        self.cache = TTLCache(ttl=cache_ttl)
+        self.in_flight = 0
+
+    async def _flush_pending(self, google_user_id):
+        """Wait for the queued increments of a user, so a read sees them. Return whether some are still queued."""
+        if self.write_behind_queue.is_pending('user_generations', google_user_id):
+            await self.write_behind_queue.wait_flushed()
+        return self.write_behind_queue.is_pending('user_generations', google_user_id)
+
+    def _adjust_cached(self, google_user_id, amount):
+        remaining_generations = self.cache.peek(google_user_id)
+        if remaining_generations is not None:
+            self.cache.replace(google_user_id, remaining_generations + amount)
+
+    async def remaining(self, google_user_id):
+        """Return the number of generations left for the user, creating the quota on first use."""
+        remaining_generations = self.cache.get(google_user_id)
+        if remaining_generations is not None:
+            return remaining_generations
+
+        still_pending = await self._flush_pending(google_user_id)
+        user_generations_data = await self.repository.get_user_generations(google_user_id)
+        if user_generations_data:
+            remaining_generations = user_generations_data['remaining_generations']
+        else:
+            # create a new document for the user with the remaining generations
+            await self.repository.create_user_generations(google_user_id, self.default_generations)
+            remaining_generations = self.default_generations
+        # a read missing queued increments must not become the cached count
+        if not still_pending:
+            self.cache.set(google_user_id, remaining_generations)
+        return remaining_generations
+
+    async def reserve(self, google_user_id):
+        """Reserve one generation for the user, returning False if none are left."""
+        # Refunds still queued by this process count towards the stored quota
+        await self._flush_pending(google_user_id)
+        remaining_generations = await self.repository.reserve_generation(google_user_id)
+        if remaining_generations is None and self.cache.peek(google_user_id) is None:
+            # the quota document may not exist yet, it is created on first use
+            await self.remaining(google_user_id)
+            remaining_generations = await self.repository.reserve_generation(google_user_id)
+        if remaining_generations is None:
+            self.cache.set(google_user_id, 0)
+            return False
+        self.cache.set(google_user_id, remaining_generations)
+
+        self.in_flight += 1
+        return True
+
+    def commit(self, google_user_id):
+        """Keep a reserved generation once the turn has been saved."""
+        self.in_flight -= 1
+
+    def refund(self, google_user_id):
+        """Give back a reserved generation when the turn failed."""
+        self.in_flight -= 1
+        self.write_behind_queue.enqueue([Write('increment', 'user_generations', google_user_id, {
+            'remaining_generations': 1,
+        })])
+        self._adjust_cached(google_user_id, 1)
+
+    async def credit(self, google_user_id, amount, writes=()):
+        """
+        Add purchased generations to the user, committed before returning together with writes, e.g. the payment
+        record, so the credit is applied exactly when they are.
+        """
+        # Make sure the quota document exists before incrementing it
+        await self.remaining(google_user_id)
+        await self.repository.commit_writes([*writes, Write('increment', 'user_generations', google_user_id, {
+            'remaining_generations': amount,
+        })])
+        self._adjust_cached(google_user_id, amount)
+
+    def stats(self):
+        """Return cache and reservation counters."""
+        return {
+            "cache": self.cache.stats(),
+            "in_flight_reservations": self.in_flight,
+        }
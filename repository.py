@@ -0,0 +1,267 @@
+"""Async data-access layer for the Firestore collections used by the application, and its in-memory backend."""
+import copy
+import datetime
+import time
+import uuid
+from collections import namedtuple
+
+
+# A single document write applied as part of a batch. operation is 'set', 'create' (fails the batch with
+# DocumentExists if the document exists), 'update' or 'increment' (data maps numeric fields to the amount
+# added server-side), the backend adds the timestamps.
+Write = namedtuple('Write', ['operation', 'collection', 'document_id', 'data'])
+
+
+class DocumentExists(Exception):
+    """Raised when a batch with a 'create' write targets a document that already exists, nothing is applied."""
+
+
+class Repository:
+    """
+    Interface of the data-access layer. Every method is a coroutine so handlers never block the event loop.
+    Documents are returned as plain dicts, or None when they do not exist.
+    """
+
+    async def get_user(self, google_user_id):
+        """Get a user by google_user_id."""
+        raise NotImplementedError
+
+    async def create_user(self, google_user_id, user_data):
+        """Create a user document."""
+        raise NotImplementedError
+
+    async def get_chat(self, chat_id):
+        """Get a chat by chat_id."""
+        raise NotImplementedError
+
+    async def list_chats(self, google_user_id, limit, offset=0, start_after=None):
+        """
+        List the chats of a user ordered by (updated_at, chat_id), most recently updated first.
+        start_after is the (updated_at, chat_id) of the last chat of the previous page and costs no skipped reads,
+        offset is only kept for page-number pagination.
+        """
+        raise NotImplementedError
+
+    async def list_chat_history(self, chat_id, limit, start_after=None):
+        """
+        List a page of the messages of a chat in (created_at, document ID) order, as (document_id, data) pairs.
+        start_after is the (created_at, document_id) of the last message of the previous page.
+        """
+        raise NotImplementedError
+
+    async def get_user_generations(self, google_user_id):
+        """Get the user_generations document of a user."""
+        raise NotImplementedError
+
+    async def create_user_generations(self, google_user_id, remaining_generations):
+        """Create the user_generations document of a user."""
+        raise NotImplementedError
+
+    async def reserve_generation(self, google_user_id):
+        """Atomically take one generation if any are left, returning the new remaining count or None."""
+        raise NotImplementedError
+
+    async def add_order(self, order_data):
+        """Add an order to the orders collection."""
+        raise NotImplementedError
+
+    async def find_payment(self, payment_id, customer_id=None):
+        """Find a payment by payment_id, optionally restricted to a customer."""
+        raise NotImplementedError
+
+    async def list_payments(self, customer_id):
+        """List the payments of a customer, most recently updated first."""
+        raise NotImplementedError
+
+    async def has_payment(self, customer_id):
+        """Return whether a customer has made any payment."""
+        raise NotImplementedError
+
+    async def commit_writes(self, writes):
+        """Apply a list of Write operations atomically and in order."""
+        raise NotImplementedError
+
+
+class InMemoryRepository(Repository):
+    """
+    Repository that keeps every collection in process memory.
+    Used to run and load-test the endpoints offline, nothing is persisted across restarts.
+    """
+
+    def __init__(self):
+        self.collections = {
+            'users': {},
+            'chats': {},
+            'chat_history': {},
+            'user_generations': {},
+            'orders': {},
+            'payments': {},
+        }
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def _get(self, collection, document_id):
+        document = self.collections[collection].get(document_id)
+        return copy.deepcopy(document) if document is not None else None
+
+    def _add(self, collection, data):
+        now = self._now()
+        self.collections[collection][str(uuid.uuid4())] = {**copy.deepcopy(data), 'created_at': now, 'updated_at': now}
+
+    def _where(self, collection, **filters):
+        return [
+            copy.deepcopy(document)
+            for document in self.collections[collection].values()
+            if all(document.get(field) == value for field, value in filters.items())
+        ]
+
+    async def get_user(self, google_user_id):
+        return self._get('users', google_user_id)
+
+    async def create_user(self, google_user_id, user_data):
+        self.collections['users'][google_user_id] = {**copy.deepcopy(user_data), 'created_at': self._now()}
+
+    async def get_chat(self, chat_id):
+        return self._get('chats', chat_id)
+
+    async def list_chats(self, google_user_id, limit, offset=0, start_after=None):
+        chats = self._where('chats', google_user_id=google_user_id)
+        chats.sort(key=lambda chat: (chat['updated_at'], chat['chat_id']), reverse=True)
+        if start_after is not None:
+            chats = [chat for chat in chats if (chat['updated_at'], chat['chat_id']) < tuple(start_after)]
+            offset = 0
+        return chats[offset:offset + limit]
+
+    async def list_chat_history(self, chat_id, limit, start_after=None):
+        chat_history = [
+            (document_id, copy.deepcopy(document))
+            for document_id, document in self.collections['chat_history'].items()
+            if document.get('chat_id') == chat_id
+        ]
+        chat_history.sort(key=lambda item: (item[1]['created_at'], item[0]))
+        if start_after is not None:
+            chat_history = [item for item in chat_history if (item[1]['created_at'], item[0]) > tuple(start_after)]
+        return chat_history[:limit]
+
+    async def get_user_generations(self, google_user_id):
+        return self._get('user_generations', google_user_id)
+
+    async def create_user_generations(self, google_user_id, remaining_generations):
+        now = self._now()
+        self.collections['user_generations'][google_user_id] = {
+            'google_user_id': google_user_id,
+            'remaining_generations': remaining_generations,
+            'created_at': now,
+            'updated_at': now,
+        }
+
+    async def reserve_generation(self, google_user_id):
+        user_generations = self.collections['user_generations'].get(google_user_id)
+        if not user_generations or user_generations['remaining_generations'] <= 0:
+            return None
+        user_generations['remaining_generations'] -= 1
+        user_generations['updated_at'] = self._now()
+        return user_generations['remaining_generations']
+
+    async def add_order(self, order_data):
+        self._add('orders', order_data)
+
+    async def find_payment(self, payment_id, customer_id=None):
+        filters = {'payment_id': payment_id}
+        if customer_id is not None:
+            filters['customer_id'] = customer_id
+        payments = self._where('payments', **filters)
+        return payments[0] if payments else None
+
+    async def list_payments(self, customer_id):
+        payments = self._where('payments', customer_id=customer_id)
+        payments.sort(key=lambda payment: payment['updated_at'], reverse=True)
+        return payments
+
+    async def has_payment(self, customer_id):
+        return any(payment.get('customer_id') == customer_id for payment in self.collections['payments'].values())
+
+    async def commit_writes(self, writes):
+        # Validate the whole batch before applying anything, so a failed batch leaves no partial writes
+        created = set()
+        for write in writes:
+            key = (write.collection, write.document_id)
+            if write.operation == 'create' and (key in created or write.document_id in self.collections[write.collection]):
+                raise DocumentExists(f'{write.collection} document already exists: {write.document_id}')
+            if write.operation in ('set', 'create'):
+                created.add(key)
+            elif key not in created and write.document_id not in self.collections[write.collection]:
+                raise KeyError(f'No {write.collection} document to update: {write.document_id}')
+
+        now = self._now()
+        for write in writes:
+            documents = self.collections[write.collection]
+            if write.operation in ('set', 'create'):
+                documents[write.document_id] = {**copy.deepcopy(write.data), 'created_at': now, 'updated_at': now}
+            elif write.operation == 'increment':
+                document = documents[write.document_id]
+                for field, amount in write.data.items():
+                    document[field] = document.get(field, 0) + amount
+                document['updated_at'] = now
+            else:
+                documents[write.document_id].update({**copy.deepcopy(write.data), 'updated_at': now})
+
+
+class TimedRepository(Repository):
+    """
+    Wraps a repository and reports how long each call took with observe(collection, operation, seconds).
+    A batch of writes is reported under its collections joined with '+'.
+    """
+
+    def __init__(self, repository, observe):
+        self.repository = repository
+        self.observe = observe
+
+    async def _timed(self, collection, operation, coroutine):
+        started = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            self.observe(collection, operation, time.perf_counter() - started)
+
+    async def get_user(self, google_user_id):
+        return await self._timed('users', 'get_user', self.repository.get_user(google_user_id))
+
+    async def create_user(self, google_user_id, user_data):
+        return await self._timed('users', 'create_user', self.repository.create_user(google_user_id, user_data))
+
+    async def get_chat(self, chat_id):
+        return await self._timed('chats', 'get_chat', self.repository.get_chat(chat_id))
+
+    async def list_chats(self, google_user_id, limit, offset=0, start_after=None):
+        return await self._timed('chats', 'list_chats', self.repository.list_chats(google_user_id, limit, offset=offset, start_after=start_after))
+
+    async def list_chat_history(self, chat_id, limit, start_after=None):
+        return await self._timed('chat_history', 'list_chat_history', self.repository.list_chat_history(chat_id, limit, start_after=start_after))
+
+    async def get_user_generations(self, google_user_id):
+        return await self._timed('user_generations', 'get_user_generations', self.repository.get_user_generations(google_user_id))
+
+    async def create_user_generations(self, google_user_id, remaining_generations):
+        return await self._timed('user_generations', 'create_user_generations', self.repository.create_user_generations(google_user_id, remaining_generations))
+
+    async def reserve_generation(self, google_user_id):
+        return await self._timed('user_generations', 'reserve_generation', self.repository.reserve_generation(google_user_id))
+
+    async def add_order(self, order_data):
+        return await self._timed('orders', 'add_order', self.repository.add_order(order_data))
+
+    async def find_payment(self, payment_id, customer_id=None):
+        return await self._timed('payments', 'find_payment', self.repository.find_payment(payment_id, customer_id))
+
+    async def list_payments(self, customer_id):
+        return await self._timed('payments', 'list_payments', self.repository.list_payments(customer_id))
+
+    async def has_payment(self, customer_id):
+        return await self._timed('payments', 'has_payment', self.repository.has_payment(customer_id))
+
+    async def commit_writes(self, writes):
+        collection = '+'.join(sorted({write.collection for write in writes}))
+        return await self._timed(collection, 'commit_writes', self.repository.commit_writes(writes))
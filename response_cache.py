@@ -0,0 +1,50 @@
+"""Opt-in cache of complete answers to deterministic (temperature 0) prompts."""
+import hashlib
+import json
+
+from cache import TTLCache
+
+
+def normalize_text(text):
+    """Collapse whitespace so prompts that differ only in spacing share an entry."""
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    """
+    Answers keyed by a hash of model, temperature, normalized history and input.
+    Entries keep the streamed chunks so a hit replays with the same frames as the original stream.
+    """
+
+    def __init__(self, max_size=5000, ttl=86400.0, max_temperature=0.0, max_answer_chars=20000):
+        self.max_temperature = max_temperature
+        self.max_answer_chars = max_answer_chars
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)
+
+    def is_cacheable(self, temperature):
+        """Return whether answers at this temperature are reproducible enough to be cached."""
+        return temperature <= self.max_temperature
+
+    @staticmethod
+    def key(model_name, temperature, history_messages, user_input):
+        """Hash the request, history messages are langchain messages as sent to the provider."""
+        payload = json.dumps([
+            model_name,
+            temperature,
+            [[message.type, normalize_text(message.content)] for message in history_messages],
+            normalize_text(user_input),
+        ], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached list of streamed chunks, or None."""
+        return self.cache.get(key)
+
+    def set(self, key, chunks):
+        """Cache the chunks of a completed answer, very long answers are not worth the memory."""
+        if sum(len(chunk) for chunk in chunks) <= self.max_answer_chars:
+            self.cache.set(key, tuple(chunks))
+
+    def stats(self):
+        """Return the cache counters."""
+        return self.cache.stats()
@@ -0,0 +1,235 @@
+"""Per-provider and per-model admission of LLM calls with fair queuing across users."""
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+
+# Queue classes, served in this order, background calls (titles, summaries) only get the room users leave
+PAID = 0
+FREE = 1
+BACKGROUND = 2
+
+
+class QueueTimeout(Exception):
+    """Raised when a call waited longer than max_wait for a slot."""
+
+
+class RateLimit:
+    """Concurrency and tokens-per-minute budget of a provider or a model, None means unlimited."""
+
+    def __init__(self, concurrency=None, tokens_per_minute=None):
+        self.concurrency = concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        # (time, tokens) spent within the last minute, corrections may be negative
+        self.window = deque()
+        self.window_tokens = 0
+
+    def _expire(self, now):
+        while self.window and self.window[0][0] <= now - 60:
+            self.window_tokens -= self.window.popleft()[1]
+
+    def can_admit(self, tokens, now):
+        """Return whether a call of tokens fits, a single call larger than the budget passes when the window is empty."""
+        if self.concurrency is not None and self.in_flight >= self.concurrency:
+            return False
+        if self.tokens_per_minute is not None:
+            self._expire(now)
+            if self.window_tokens > 0 and self.window_tokens + tokens > self.tokens_per_minute:
+                return False
+        return True
+
+    def acquire(self, tokens, now):
+        self.in_flight += 1
+        self.spend(tokens, now)
+
+    def spend(self, tokens, now):
+        if self.tokens_per_minute is not None and tokens:
+            self.window.append((now, tokens))
+            self.window_tokens += tokens
+
+    def tokens_last_minute(self, now):
+        self._expire(now)
+        return self.window_tokens
+
+    def next_expiry(self):
+        """Return when the oldest spend leaves the window, or None."""
+        return self.window[0][0] + 60 if self.window else None
+
+
+class Ticket:
+    """A granted slot, release it exactly once with the tokens actually used."""
+
+    def __init__(self, scheduler, provider, model_name, tokens):
+        self.scheduler = scheduler
+        self.provider = provider
+        self.model_name = model_name
+        self.tokens = tokens
+        self.released = False
+
+    def release(self, used_tokens=None):
+        """Give the slot back, correcting the token budget with the tokens actually used."""
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self, used_tokens)
+
+
+class _Waiter:
+    __slots__ = ('user_id', 'model_name', 'tokens', 'future', 'enqueued_at')
+
+    def __init__(self, user_id, model_name, tokens, future, enqueued_at):
+        self.user_id = user_id
+        self.model_name = model_name
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+class Scheduler:
+    """
+    Admits calls when both their provider and model budgets allow it, otherwise queues them.
+    Queued calls are served paid users first, then free users, then background calls, round robin across users
+    within each class, so one user's burst does not hold back everyone else.
+    """
+
+    def __init__(self, provider_limits, model_limits, max_wait=30.0):
+        self.max_wait = max_wait
+        self.provider_limits = {provider: RateLimit(**limits) for provider, limits in provider_limits.items()}
+        self.model_limits = {model_name: RateLimit(**limits) for model_name, limits in model_limits.items()}
+        # provider -> [paid users, free users, background callers], each an OrderedDict of user_id -> deque of waiters
+        self._queues = {}
+        self._timers = {}
+        self.admitted = 0
+        self.queued = 0
+        self.timed_out = 0
+        self.dequeued = 0
+        self.total_wait = 0.0
+        self.max_observed_wait = 0.0
+
+    def _limits(self, provider, model_name):
+        return [limit for limit in (self.provider_limits.get(provider), self.model_limits.get(model_name)) if limit is not None]
+
+    def _can_admit(self, provider, model_name, tokens, now):
+        return all(limit.can_admit(tokens, now) for limit in self._limits(provider, model_name))
+
+    def _admit(self, provider, model_name, tokens, now):
+        for limit in self._limits(provider, model_name):
+            limit.acquire(tokens, now)
+        self.admitted += 1
+        return Ticket(self, provider, model_name, tokens)
+
+    async def acquire(self, provider, model_name, user_id, tokens, priority=FREE):
+        """Wait for a slot for a call of about tokens tokens, raising QueueTimeout after max_wait seconds."""
+        now = time.monotonic()
+        queues = self._queues.setdefault(provider, [OrderedDict(), OrderedDict(), OrderedDict()])
+        if not any(queues) and self._can_admit(provider, model_name, tokens, now):
+            return self._admit(provider, model_name, tokens, now)
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(user_id, model_name, tokens, future, now)
+        queues[priority].setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        self._dispatch(provider)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # granted while timing out, give the slot back
+                future.result().release(0)
+            else:
+                future.cancel()
+                self._remove(provider, priority, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise QueueTimeout(f"No {provider} capacity within {self.max_wait} seconds") from e
+            raise
+
+    def try_acquire(self, provider, model_name, tokens):
+        """Return a slot if one is free right now and nobody is queued for the provider, otherwise None."""
+        queues = self._queues.get(provider)
+        if queues and any(queues):
+            return None
+        now = time.monotonic()
+        if self._can_admit(provider, model_name, tokens, now):
+            return self._admit(provider, model_name, tokens, now)
+        return None
+
+    def _remove(self, provider, priority, waiter):
+        users = self._queues[provider][priority]
+        waiters = users.get(waiter.user_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del users[waiter.user_id]
+
+    def _dispatch(self, provider):
+        """Admit queued calls of a provider while its budgets allow."""
+        queues = self._queues.get(provider)
+        if not queues:
+            return
+        now = time.monotonic()
+        admitted = True
+        while admitted:
+            admitted = False
+            for users in queues:
+                for user_id in list(users):
+                    waiter = users[user_id][0]
+                    if not self._can_admit(provider, waiter.model_name, waiter.tokens, now):
+                        continue
+                    users[user_id].popleft()
+                    if users[user_id]:
+                        users.move_to_end(user_id)
+                    else:
+                        del users[user_id]
+                    wait = now - waiter.enqueued_at
+                    self.dequeued += 1
+                    self.total_wait += wait
+                    self.max_observed_wait = max(self.max_observed_wait, wait)
+                    waiter.future.set_result(self._admit(provider, waiter.model_name, waiter.tokens, now))
+                    admitted = True
+                    break
+                if admitted:
+                    break
+        if any(queues):
+            self._schedule_retry(provider)
+
+    def _schedule_retry(self, provider):
+        """Dispatch again when token budget spend leaves the window, releases dispatch on their own."""
+        expiries = [limit.next_expiry() for limit in self.provider_limits.values() if limit.next_expiry() is not None]
+        expiries += [limit.next_expiry() for limit in self.model_limits.values() if limit.next_expiry() is not None]
+        if not expiries or provider in self._timers:
+            return
+        delay = max(min(expiries) - time.monotonic(), 0.05)
+
+        def retry():
+            del self._timers[provider]
+            self._dispatch(provider)
+
+        self._timers[provider] = asyncio.get_running_loop().call_later(delay, retry)
+
+    def _release(self, ticket, used_tokens):
+        now = time.monotonic()
+        for limit in self._limits(ticket.provider, ticket.model_name):
+            limit.in_flight -= 1
+            if used_tokens is not None:
+                limit.spend(used_tokens - ticket.tokens, now)
+        self._dispatch(ticket.provider)
+
+    def stats(self):
+        """Return the in-flight calls, queue depths and wait times."""
+        now = time.monotonic()
+        return {
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "timed_out": self.timed_out,
+            "average_wait_s": self.total_wait / self.dequeued if self.dequeued else 0.0,
+            "max_wait_s": self.max_observed_wait,
+            "providers": {
+                provider: {
+                    "in_flight": limit.in_flight,
+                    "tokens_last_minute": limit.tokens_last_minute(now),
+                    "queue_depth": sum(len(waiters) for users in self._queues.get(provider, ()) for waiters in users.values()),
+                }
+                for provider, limit in self.provider_limits.items()
+            },
+        }
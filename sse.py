@@ -0,0 +1,141 @@
+"""Server-sent event frames for the chat streaming endpoint."""
+import asyncio
+import json
+from collections import deque
+
+try:
+    import orjson
+except ImportError:  # orjson comes with langsmith, fall back to the standard library without it
+    orjson = None
+
+
+# Frames are the ChatEventStreaming model serialized with its fields in order, only the token is escaped per frame
+STREAM_PREFIX = b'data: {"event":"stream","data":'
+STREAM_SUFFIX = b',"is_final":false,"chat_id":null}\n\n'
+FINAL_PREFIX = b'data: {"event":"stream","data":"","is_final":true,"chat_id":'
+FINAL_SUFFIX = b'}\n\n'
+
+
+def json_string(text):
+    """Return text as a JSON string literal in UTF-8."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(text)
+        except TypeError:
+            # orjson rejects lone surrogates, json escapes them
+            pass
+    return json.dumps(text).encode('utf-8')
+
+
+def encode_token(token):
+    """Return the SSE frame of a streamed token."""
+    return STREAM_PREFIX + json_string(token) + STREAM_SUFFIX
+
+
+def encode_final(chat_id=None):
+    """Return the SSE frame that ends a stream."""
+    return FINAL_PREFIX + (json_string(chat_id) if chat_id is not None else b'null') + FINAL_SUFFIX
+
+
+def encode_event(event, data):
+    """Return a named SSE frame carrying data as JSON, e.g. the timing breakdown sent after the final frame."""
+    if orjson is not None:
+        payload = orjson.dumps(data)
+    else:
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return b'event: ' + event.encode('utf-8') + b'\ndata: ' + payload + b'\n\n'
+
+
+async def coalesce(tokens, interval=0.015, max_chars=512, stop=None):
+    """
+    Group the tokens of an async iterator into chunks of at most max_chars characters, sent at most interval seconds
+    after their first token or as soon as they reach max_chars. The first token is never held back, and a token
+    longer than max_chars is split. With interval 0 every token is sent on its own as soon as it arrives.
+    Once the optional stop future is done, iteration ends and the source is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    max_chars = max(max_chars, 1)
+    buffer = deque()
+    size = 0
+    buffered_at = 0.0
+    finished = False
+    error = None
+    # Futures the consumer waits on: any token arriving, and the buffer reaching max_chars
+    arrived = None
+    full = None
+
+    def wake(future):
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def take():
+        # The buffered tokens that fit in one chunk, a single token per chunk with interval 0
+        nonlocal size
+        parts = []
+        length = 0
+        while buffer:
+            token = buffer[0]
+            room = max_chars - length
+            if len(token) > room:
+                if not parts:
+                    parts.append(token[:room])
+                    buffer[0] = token[room:]
+                    length = room
+                break
+            parts.append(buffer.popleft())
+            length += len(token)
+            if interval <= 0:
+                break
+        size -= length
+        return "".join(parts)
+
+    async def pump():
+        # The source is iterated by a single task of its own, so provider streams never change task mid-iteration
+        nonlocal size, buffered_at, finished, error
+        try:
+            async for token in tokens:
+                if not buffer:
+                    buffered_at = loop.time()
+                buffer.append(token)
+                size += len(token)
+                wake(arrived)
+                if size >= max_chars:
+                    wake(full)
+        except Exception as e:
+            error = e
+        finally:
+            finished = True
+            wake(arrived)
+            wake(full)
+
+    producer = asyncio.create_task(pump())
+    try:
+        first = True
+        while True:
+            if not buffer and not finished:
+                arrived = loop.create_future()
+                await asyncio.wait((arrived, stop) if stop is not None else (arrived,), return_when=asyncio.FIRST_COMPLETED)
+                arrived = None
+            if buffer and not first and not finished and size < max_chars and interval > 0:
+                remaining = buffered_at + interval - loop.time()
+                if remaining > 0:
+                    full = loop.create_future()
+                    await asyncio.wait((full, stop) if stop is not None else (full,), timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                    full = None
+            if stop is not None and stop.done():
+                return
+            if buffer:
+                chunk = take()
+                first = False
+                yield chunk
+            if finished and not buffer:
+                if error is not None:
+                    raise error
+                return
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
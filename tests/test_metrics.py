@@ -0,0 +1,48 @@
+import os
+import runpy
+
+import metrics
+
+# A module defining its metrics at import time, like app.py
+METRICS_MODULE = '''
+import metrics
+requests = metrics.Counter("requests", "Requests served.", ("outcome",), registry=registry)
+latency = metrics.Histogram("latency_seconds", "Request latency.", buckets=(0.1, 1.0), registry=registry)
+'''
+
+
+def test_render_after_double_import(tmp_path):
+    path = tmp_path / "module.py"
+    path.write_text(METRICS_MODULE)
+    registry = metrics.Registry()
+    # python app.py runs the module as __main__, then uvicorn imports it again as app
+    first = runpy.run_path(str(path), init_globals={"registry": registry}, run_name="__main__")
+    second = runpy.run_path(str(path), init_globals={"registry": registry}, run_name="app")
+    first["requests"].labels("stale").inc()
+    second["requests"].labels("completed").inc(2)
+
+    text = registry.render()
+
+    assert text.count("# TYPE requests_total counter") == 1
+    assert text.count("# TYPE latency_seconds histogram") == 1
+    # the definitions imported last are the ones rendered
+    assert 'requests_total{outcome="completed"} 2.0' in text
+    assert "stale" not in text
+
+
+def test_render_sums_worker_snapshots(tmp_path):
+    registries = [metrics.Registry() for _ in range(2)]
+    for worker, registry in enumerate(registries):
+        counter = metrics.Counter("requests", "Requests served.", registry=registry)
+        histogram = metrics.Histogram("latency_seconds", "Request latency.", buckets=(0.1, 1.0), registry=registry)
+        counter.inc(worker + 1)
+        histogram.observe(0.05 * (worker + 1))
+    # both registries live in this process, so move the other worker's snapshot out of the way of this one
+    registries[1].write_snapshot(str(tmp_path))
+    (tmp_path / f"{os.getpid()}.json").rename(tmp_path / "worker.json")
+
+    text = registries[0].render(str(tmp_path))
+
+    assert "requests_total 3.0" in text
+    assert 'latency_seconds_bucket{le="0.1"} 2' in text
+    assert "latency_seconds_count 2" in text
@@ -0,0 +1,48 @@
+import asyncio
+
+from quota import QuotaManager
+from repository import InMemoryRepository
+from write_behind import WriteBehindQueue
+
+
+def test_processes_sharing_a_database_never_overspend():
+    async def run():
+        repository = InMemoryRepository()
+        # each worker process has its own write-behind queue and quota cache, only the database is shared
+        workers = []
+        for _ in range(3):
+            write_behind_queue = WriteBehindQueue(repository)
+            write_behind_queue.start()
+            workers.append(QuotaManager(repository, write_behind_queue, default_generations=20))
+        # every worker caches the full quota first
+        for quota in workers:
+            assert await quota.remaining("user") == 20
+
+        results = await asyncio.gather(*(workers[index % 3].reserve("user") for index in range(60)))
+        for quota in workers:
+            await quota.write_behind_queue.stop()
+        return results, await repository.get_user_generations("user")
+
+    results, user_generations = asyncio.run(run())
+
+    assert sum(results) == 20
+    assert user_generations["remaining_generations"] == 0
+
+
+def test_refund_gives_the_generation_back():
+    async def run():
+        repository = InMemoryRepository()
+        write_behind_queue = WriteBehindQueue(repository)
+        write_behind_queue.start()
+        quota = QuotaManager(repository, write_behind_queue, default_generations=1)
+        assert await quota.reserve("user")
+        assert not await quota.reserve("user")
+        quota.refund("user")
+        reserved = await quota.reserve("user")
+        await write_behind_queue.stop()
+        return reserved, await repository.get_user_generations("user")
+
+    reserved, user_generations = asyncio.run(run())
+
+    assert reserved
+    assert user_generations["remaining_generations"] == 0
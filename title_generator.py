@@ -0,0 +1,84 @@
+"""Background chat title generation from a capped prefix of the conversation."""
+import asyncio
+import logging
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from cache import TTLCache
+
+
+# Default model used to title every chat, whatever model the chat itself uses
+TITLE_MODEL = "gpt-4o-mini"
+
+TITLE_INSTRUCTION = "Generate a concise and relevant 5-word title for the above chat based on the main topic discussed. Do not include any creative or ambiguous terms."
+
+
+class TitleGenerator:
+    """
+    Generates chat titles in background tasks, one task per chat_id however many times it is requested.
+    Only the first max_turns turns, each cut to max_message_chars, are sent to the title model.
+    Finished titles are passed to save_title and kept for ttl seconds so clients can fetch them.
+    """
+
+    def __init__(self, background_caller, save_title, title_model=TITLE_MODEL, max_turns=2, max_message_chars=1000, ttl=600.0):
+        self.background_caller = background_caller
+        self.title_model = title_model
+        self.save_title = save_title
+        self.max_turns = max_turns
+        self.max_message_chars = max_message_chars
+        self.titles = TTLCache(max_size=10000, ttl=ttl)
+        self._tasks = {}
+        self.generated = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def schedule(self, chat_id, turns):
+        """Start generating the title of a chat unless it is already generated or in progress."""
+        if chat_id in self._tasks or self.titles.peek(chat_id) is not None:
+            self.coalesced += 1
+            return
+        task = asyncio.create_task(self._generate(chat_id, list(turns[:self.max_turns])))
+        self._tasks[chat_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(chat_id, None))
+
+    def is_pending(self, chat_id):
+        """Return whether the title of a chat is being generated."""
+        return chat_id in self._tasks
+
+    async def wait(self, chat_id, timeout):
+        """Return the title of a chat, waiting up to timeout seconds for a generation in progress."""
+        task = self._tasks.get(chat_id)
+        if task is not None and timeout > 0:
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.titles.peek(chat_id)
+
+    async def _generate(self, chat_id, turns):
+        try:
+            transcript = "\n\n".join(
+                f"User: {user_message[:self.max_message_chars]}\nAssistant: {ai_message[:self.max_message_chars]}"
+                for user_message, ai_message in turns
+            )
+            response = await self.background_caller.invoke(self.title_model, "title", [
+                SystemMessage(content=f"Chat:\n{transcript}"),
+                HumanMessage(content=TITLE_INSTRUCTION),
+            ], temperature=0.8)
+            # clean the response of extra "" or /
+            title = response.content.replace('"', '').replace("/", "").strip()
+            self.titles.set(chat_id, title)
+            self.save_title(chat_id, title)
+            self.generated += 1
+        except Exception as e:
+            self.failed += 1
+            logging.error(f'Error generating title for chat {chat_id}: {e}')
+
+    def stats(self):
+        """Return the generation counters."""
+        return {
+            "in_progress": len(self._tasks),
+            "generated": self.generated,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+        }
@@ -0,0 +1,168 @@
+"""Process-wide tokenizer registry and token counting used for billing."""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Inputs longer than this many characters are counted in the process pool instead of on the event loop
+LARGE_INPUT_CHARS = 20000
+
+
+@functools.lru_cache(maxsize=None)
+def get_tiktoken_encoding(model_name):
+    """Load a tiktoken encoding once per model."""
+    import tiktoken
+    return tiktoken.encoding_for_model(model_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_anthropic_client():
+    """Load the Anthropic client whose tokenizer is used for Claude models."""
+    from anthropic import Anthropic
+    return Anthropic()
+
+
+@functools.lru_cache(maxsize=None)
+def get_gemini_tokenizer():
+    """Load the Vertex AI local tokenizer for Gemini models."""
+    from vertexai.preview import tokenization
+    return tokenization.get_tokenizer_for_model("gemini-1.5-flash-001")
+
+
+def count_openai_tokens(text, model_name):
+    """Count tokens with the model's own tiktoken encoding."""
+    return len(get_tiktoken_encoding(model_name).encode(text))
+
+
+def count_anthropic_tokens(text, model_name):
+    """Count tokens with the Anthropic tokenizer."""
+    return get_anthropic_client().count_tokens(text)
+
+
+def count_approximate_tokens(text, model_name):
+    """Approximate tokens for providers without a public tokenizer using the gpt-3.5-turbo encoding."""
+    return len(get_tiktoken_encoding("gpt-3.5-turbo").encode(text))
+
+
+def count_gemini_tokens(text, model_name):
+    """Count tokens with the Gemini tokenizer."""
+    return get_gemini_tokenizer().count_tokens(text).total_tokens
+
+
+# Token counter per company in model_company_mapping
+TOKEN_COUNTERS = {
+    "OpenAI": count_openai_tokens,
+    "Anthropic": count_anthropic_tokens,
+    "Mistral": count_approximate_tokens,
+    "Perplexity": count_approximate_tokens,
+    "Meta": count_approximate_tokens,
+    "Google": count_gemini_tokens,
+}
+
+
+def count_tokens(text, model_name, company):
+    """Count the tokens of a string for the given model."""
+    if not text:
+        return 0
+    counter = TOKEN_COUNTERS.get(company)
+    if counter is None:
+        logging.error(f'No token counter registered for company: {company}')
+        return 0
+    return counter(text, model_name)
+
+
+def count_tokens_batch(texts, model_name, company):
+    """Count the tokens of several strings for the given model."""
+    return [count_tokens(text, model_name, company) for text in texts]
+
+
+def warm_up(models):
+    """Load every tokenizer needed by the given (model_name, company) pairs."""
+    for model_name, company in models:
+        try:
+            count_tokens("warm up", model_name, company)
+        except Exception as e:
+            logging.error(f'Error warming up tokenizer for {model_name}: {e}')
+
+
+_process_pool = None
+
+
+def start_process_pool(models, max_workers=None):
+    """Start the worker processes used for large inputs and warm their tokenizers."""
+    global _process_pool
+    if _process_pool is not None:
+        return
+    max_workers = max_workers or int(os.getenv("TOKENIZER_PROCESSES", min(2, os.cpu_count() or 1)))
+    if max_workers <= 0:
+        return
+    # Spawn rather than fork, the parent already holds gRPC and HTTP client threads
+    _process_pool = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=warm_up,
+        initargs=(list(models),),
+    )
+
+
+def shutdown_process_pool():
+    """Stop the tokenizer worker processes."""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+async def acount_tokens_batch(texts, model_name, company):
+    """Count tokens without blocking the event loop on large inputs."""
+    if sum(len(text) for text in texts) < LARGE_INPUT_CHARS:
+        return count_tokens_batch(texts, model_name, company)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_process_pool, count_tokens_batch, texts, model_name, company)
+
+
+class StreamMeter:
+    """
+    Meters the tokens of a streamed response as the chunks arrive.
+    Provider-reported usage metadata is preferred, tokenizer counts are the fallback.
+    """
+
+    def __init__(self, model_name, company):
+        self.model_name = model_name
+        self.company = company
+        self.counted_output_tokens = 0
+        self.reported_input_tokens = 0
+        self.reported_output_tokens = 0
+        self._input_task = None
+
+    def start(self, input_string):
+        """Count the prompt tokens in the background while the response is streaming."""
+        self._input_task = asyncio.ensure_future(acount_tokens_batch([input_string], self.model_name, self.company))
+
+    def add_chunk(self, text, usage_metadata=None):
+        """Add a streamed chunk and any usage metadata it carries."""
+        if usage_metadata:
+            # Providers split usage across chunks (e.g. input on the first, output on the last), so sum them
+            self.reported_input_tokens += usage_metadata.get('input_tokens', 0)
+            self.reported_output_tokens += usage_metadata.get('output_tokens', 0)
+        if text:
+            self.counted_output_tokens += count_tokens(text, self.model_name, self.company)
+
+    async def totals(self):
+        """Return the (input, output) token lengths for the streamed response."""
+        output_token_length = self.reported_output_tokens or self.counted_output_tokens
+        if self.reported_input_tokens:
+            self.cancel()
+            return self.reported_input_tokens, output_token_length
+        input_token_length = 0
+        if self._input_task is not None:
+            (input_token_length,) = await self._input_task
+        return input_token_length, output_token_length
+
+    def cancel(self):
+        """Stop the background prompt count if it is still running."""
+        if self._input_task is not None and not self._input_task.done():
+            self._input_task.cancel()
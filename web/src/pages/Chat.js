@@ -5,6 +5,7 @@ import InputBar from '../components/InputBar';
 import LoadingSpinner from '../components/LoadingSpinner'; // Import the LoadingSpinner component
 import { Select, SelectItem, Button, Dropdown, DropdownTrigger, Avatar, DropdownMenu, DropdownItem } from '@nextui-org/react';
 import { modelOptions } from '../options/modelOptions';
+import { fetchUnavailableModels } from '../utils/fetchUnavailableModels';
 import { fetchEventSource } from '@microsoft/fetch-event-source';
 import { BsSendArrowUp } from "react-icons/bs";
 import { AiOutlineReload } from 'react-icons/ai';
@@ -22,6 +23,7 @@ export const Chat = (props) => {
   const [isLoading, setIsLoading] = useState(false); // New state for loading
   const chatWindowRef = useRef(null);
   const [selectedModel, setSelectedModel] = useState(modelOptions[0]);
+  const [unavailableModels, setUnavailableModels] = useState([]);
   const [isStreaming, setIsStreaming] = useState(false);
   const [showRetry, setShowRetry] = useState(false); // New state for retry
   const [isRequestFailed, setIsRequestFailed] = useState(false); // New state for request failed
@@ -66,6 +68,14 @@ export const Chat = (props) => {
     await getAIResponse();
   }
 
+  useEffect(() => {
+    // refresh the provider health every minute so unhealthy models are greyed out
+    const refreshModelHealth = async () => setUnavailableModels(await fetchUnavailableModels(accessToken));
+    refreshModelHealth();
+    const interval = setInterval(refreshModelHealth, 60000);
+    return () => clearInterval(interval);
+  }, [accessToken]);
+
   useEffect(() => {
     scrollToBottom();
   }, [scrollToBottom, messages]);
@@ -170,6 +180,14 @@ export const Chat = (props) => {
       });
 
       if (response.ok) {
+        if (response.status === 202) {
+          // the title is generated in the background, wait for it before refreshing the sidebar
+          await fetch(`${API_HOST}/v1/chat_title/${chatId}?wait=15`, {
+            headers: {
+              'Authorization': `Bearer ${accessToken}`,
+            },
+          });
+        }
         await props.fetchUserChatHistory();
       } else {
         console.error('Error fetching chat title:', response.statusText);
@@ -228,6 +246,10 @@ export const Chat = (props) => {
           }
         },
         onmessage(event) {
+          // the timing breakdown sent after the final frame is not part of the answer
+          if (event.event === "timing") {
+            return;
+          }
           const data = JSON.parse(event.data);
           setIsLoading(false);
 
@@ -298,6 +320,7 @@ export const Chat = (props) => {
           <Select
             className="w-52 md:w-full ml-4"
             selectedKeys={[selectedModel?.value]}
+            disabledKeys={unavailableModels}
             onChange={(event) => setSelectedModel(
               modelOptions.find((model) => model.value === event.target.value)
             )}
@@ -11,6 +11,7 @@ import { ConfirmationModal } from '../components/ConfirmationModal';
 import { IoSettingsOutline } from "react-icons/io5";
 import { AiOutlineLogout } from "react-icons/ai";
 import { modelOptions } from '../options/modelOptions';
+import { fetchUnavailableModels } from '../utils/fetchUnavailableModels';
 import { BsSendArrowUp } from "react-icons/bs";
 import InputBar from "../components/InputBar";
 import { UserCard } from '../components/UserCard';
@@ -42,6 +43,7 @@ export const DashboardV2 = () => {
     const [modal, setModal] = useState(null);
     const [isSidebarOpen, setIsSidebarOpen] = useState(false);
     const [selectedModel, setSelectedModel] = useState(modelOptions.find((model) => model.value === userModel) || modelOptions[0]);
+    const [unavailableModels, setUnavailableModels] = useState([]);
     const [messages, setMessages] = useState([]);
     let previousModel = null;
     let profilePicture = localStorage.getItem("profilePicture");
@@ -112,6 +114,14 @@ export const DashboardV2 = () => {
             });
 
             if (response.ok) {
+                if (response.status === 202) {
+                    // the title is generated in the background, wait for it before refreshing the sidebar
+                    await fetch(`${API_HOST}/v1/chat_title/${chatId}?wait=15`, {
+                        headers: {
+                            'Authorization': `Bearer ${accessToken}`,
+                        },
+                    });
+                }
                 await fetchUserChatHistory();
             } else {
                 console.error('Error fetching chat title:', response.statusText);
@@ -178,6 +188,10 @@ export const DashboardV2 = () => {
                     }
                 },
                 onmessage(event) {
+                    // the timing breakdown sent after the final frame is not part of the answer
+                    if (event.event === "timing") {
+                      return;
+                    }
                     const data = JSON.parse(event.data);
                     setIsLoadingGeneratingChat(false);
 
@@ -283,6 +297,14 @@ export const DashboardV2 = () => {
         await getAIResponse(messages[messages.length - 1].user_message, messages.slice(0, messages.length - 1), regenerateMessage);
     }
 
+    useEffect(() => {
+        // refresh the provider health every minute so unhealthy models are greyed out
+        const refreshModelHealth = async () => setUnavailableModels(await fetchUnavailableModels(accessToken));
+        refreshModelHealth();
+        const interval = setInterval(refreshModelHealth, 60000);
+        return () => clearInterval(interval);
+    }, [accessToken]);
+
     useEffect(() => {
         scrollToBottom();
     }, [scrollToBottom, messages]);
@@ -423,6 +445,7 @@ export const DashboardV2 = () => {
                             <Select
                                 className="w-52 md:w-full ml-4"
                                 selectedKeys={[selectedModel?.value]}
+                                disabledKeys={unavailableModels}
                                 onChange={(event) => {
                                     // check for plus subscription
                                     let selectedModel = modelOptions.find((model) => model.value === event.target.value);
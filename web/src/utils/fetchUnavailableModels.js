@@ -0,0 +1,23 @@
+export const fetchUnavailableModels = async (accessToken) => {
+    const API_HOST = process.env.REACT_APP_API_HOST || 'http://localhost:5000';
+    try {
+        const response = await fetch(`${API_HOST}/v1/models/health`, {
+            headers: {
+                'Authorization': `Bearer ${accessToken}`,
+            },
+        });
+
+        if (response.ok) {
+            const data = await response.json();
+            // models whose provider is failing right now, greyed out in the model picker
+            return Object.keys(data.models).filter((model) => !data.models[model].available);
+        } else {
+            console.error('Error fetching model health:', response.statusText);
+            return [];
+        }
+    }
+    catch (error) {
+        console.error('Error fetching model health:', error);
+        return [];
+    }
+};
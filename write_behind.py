@@ -0,0 +1,156 @@
+"""Write-behind queue that groups database writes into batched commits."""
+import asyncio
+import logging
+
+
+class WriteBehindQueue:
+    """
+    Buffers groups of writes (e.g. every write of one chat turn) and commits them to the repository
+    in batches, flushing when max_batch_size writes are queued or every flush_interval seconds.
+    """
+
+    def __init__(self, repository, max_batch_size=400, flush_interval=0.2, max_attempts=3):
+        # Firestore allows at most 500 writes per batch
+        self.repository = repository
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._groups = []
+        self._queued_writes = 0
+        self._pending_sets = {}
+        self._pending_documents = {}
+        self._enqueued_groups = 0
+        self._completed_groups = 0
+        self._flushed = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+        self.batches = 0
+        self.flushed_writes = 0
+        self.failed_writes = 0
+
+    def enqueue(self, writes):
+        """Queue a group of writes that must be committed together."""
+        writes = list(writes)
+        if not writes:
+            return
+        self._groups.append(writes)
+        self._queued_writes += len(writes)
+        self._enqueued_groups += 1
+        for write in writes:
+            key = (write.collection, write.document_id)
+            self._pending_documents[key] = self._pending_documents.get(key, 0) + 1
+            if write.operation == 'set':
+                self._pending_sets[key] = write
+        if self._queued_writes >= self.max_batch_size:
+            self._wakeup.set()
+
+    def pending(self, collection, document_id):
+        """Return the data of a document created by a queued write that has not been flushed yet."""
+        write = self._pending_sets.get((collection, document_id))
+        return write.data if write is not None else None
+
+    def is_pending(self, collection, document_id):
+        """Return whether any queued write to the document has not been flushed yet."""
+        return (collection, document_id) in self._pending_documents
+
+    async def wait_flushed(self, timeout=2.0):
+        """Wait up to timeout seconds until every write queued so far has been flushed, for reads that must see them."""
+        if self._task is None:
+            await self.flush()
+            return
+        target = self._enqueued_groups
+        self._wakeup.set()
+
+        async def flushed():
+            async with self._flushed:
+                await self._flushed.wait_for(lambda: self._completed_groups >= target)
+
+        try:
+            await asyncio.wait_for(flushed(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.error('Timed out waiting for the write-behind queue to flush')
+
+    def start(self):
+        """Start the background flush loop on the running event loop."""
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop after draining every queued write."""
+        if self._task is None:
+            await self.flush()
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f'Error flushing write-behind queue: {e}')
+        await self.flush()
+
+    async def flush(self):
+        """Commit every queued write in batches of at most max_batch_size writes."""
+        while self._groups:
+            batch_groups = []
+            batch_size = 0
+            while self._groups and (not batch_groups or batch_size + len(self._groups[0]) <= self.max_batch_size):
+                group = self._groups.pop(0)
+                batch_groups.append(group)
+                batch_size += len(group)
+            self._queued_writes -= batch_size
+
+            if not await self._commit([write for group in batch_groups for write in group]):
+                # A single bad group fails the whole batch, retry group by group so only that group is dropped
+                for group in batch_groups:
+                    if not await self._commit(group, attempts=1):
+                        self.failed_writes += len(group)
+                        logging.error(f'Dropping {len(group)} writes after failed commits: {group}')
+
+            for group in batch_groups:
+                for write in group:
+                    key = (write.collection, write.document_id)
+                    if self._pending_sets.get(key) is write:
+                        del self._pending_sets[key]
+                    self._pending_documents[key] -= 1
+                    if not self._pending_documents[key]:
+                        del self._pending_documents[key]
+
+            self._completed_groups += len(batch_groups)
+            async with self._flushed:
+                self._flushed.notify_all()
+
+    async def _commit(self, writes, attempts=None):
+        """Commit writes with retries, returning whether they were committed."""
+        attempts = attempts or self.max_attempts
+        for attempt in range(1, attempts + 1):
+            try:
+                await self.repository.commit_writes(writes)
+                self.batches += 1
+                self.flushed_writes += len(writes)
+                return True
+            except Exception as e:
+                logging.error(f'Error committing batch of {len(writes)} writes (attempt {attempt}): {e}')
+                if attempt < attempts:
+                    await asyncio.sleep(0.1 * attempt)
+        return False
+
+    def stats(self):
+        """Return queue depth and flush counters."""
+        return {
+            "queued_writes": self._queued_writes,
+            "batches": self.batches,
+            "flushed_writes": self.flushed_writes,
+            "failed_writes": self.failed_writes,
+        }